@@ -0,0 +1,149 @@
+"""ai.py - Perfect-play TicTacToe opponent.
+
+Every reachable position is solved ahead of time by a negamax search and the
+best move of each one is kept in ai_table.bin. Positions are reduced by the 8
+symmetries of the board, so the table holds one entry per equivalence class.
+The table is loaded once per instance and answering a move is a lookup.
+
+Rebuild the table after changing the solver with:
+    python ai.py
+"""
+
+import os
+import struct
+
+import engine
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'ai_table.bin')
+# Each table record is the position code and the best cell to move on
+RECORD = struct.Struct('<HB')
+
+
+def _symmetries():
+    """Returns the 8 symmetries of the board as cell permutations, where
+    permutation[cell] is the cell it moves to"""
+    def cell(row, col):
+        return row * 3 + col
+    transforms = (
+        lambda r, c: (r, c),
+        lambda r, c: (c, 2 - r),
+        lambda r, c: (2 - r, 2 - c),
+        lambda r, c: (2 - c, r),
+        lambda r, c: (r, 2 - c),
+        lambda r, c: (2 - r, c),
+        lambda r, c: (c, r),
+        lambda r, c: (2 - c, 2 - r),
+    )
+    return tuple(tuple(cell(*transform(index // 3, index % 3))
+                       for index in range(9))
+                 for transform in transforms)
+
+
+SYMMETRIES = _symmetries()
+
+
+def position_code(x_mask, o_mask, permutation=SYMMETRIES[0]):
+    """Returns the base 3 code of the position (1 for X, 2 for O per cell)
+    after moving every cell through the permutation"""
+    code = 0
+    for cell in range(9):
+        if x_mask >> cell & 1:
+            code += 3 ** permutation[cell]
+        elif o_mask >> cell & 1:
+            code += 2 * 3 ** permutation[cell]
+    return code
+
+
+def canonical(x_mask, o_mask):
+    """Returns the smallest code of the position over all the symmetries,
+    with the permutation that produces it"""
+    return min((position_code(x_mask, o_mask, permutation), permutation)
+               for permutation in SYMMETRIES)
+
+
+def _negamax(x_mask, o_mask, scores):
+    """Returns the score of the position for the side to move: positive for
+    a win, negative for a loss, 0 for a draw. Quicker wins and slower losses
+    score further from 0. scores memoizes the canonical positions."""
+    code = canonical(x_mask, o_mask)[0]
+    if code in scores:
+        return scores[code]
+    x_to_move = bin(x_mask).count('1') == bin(o_mask).count('1')
+    opponent = o_mask if x_to_move else x_mask
+    empty = engine.FULL_BOARD & ~(x_mask | o_mask)
+    if engine.is_win(opponent):
+        score = -1 - bin(empty).count('1')
+    elif not empty:
+        score = 0
+    else:
+        score = max(-_negamax(*_after(x_mask, o_mask, x_to_move, cell),
+                              scores=scores)
+                    for cell in range(9) if empty >> cell & 1)
+    scores[code] = score
+    return score
+
+
+def _after(x_mask, o_mask, x_to_move, cell):
+    """Returns the masks after the side to move takes cell"""
+    if x_to_move:
+        return engine.place(x_mask, cell), o_mask
+    return x_mask, engine.place(o_mask, cell)
+
+
+def solve():
+    """Solves every reachable position. Returns a dict mapping the canonical
+    code of each position with a move to make to its best cell, in the
+    canonical orientation."""
+    scores = {}
+    table = {}
+    pending = [(0, 0)]
+    while pending:
+        x_mask, o_mask = pending.pop()
+        code, permutation = canonical(x_mask, o_mask)
+        if code in table or engine.is_win(x_mask) or \
+                engine.is_win(o_mask) or engine.is_full(x_mask, o_mask):
+            continue
+        x_to_move = bin(x_mask).count('1') == bin(o_mask).count('1')
+        best_cell, best_score = None, None
+        for cell in range(9):
+            if not engine.is_free(x_mask, o_mask, cell):
+                continue
+            after = _after(x_mask, o_mask, x_to_move, cell)
+            score = -_negamax(after[0], after[1], scores)
+            # Ties go to the lowest canonical cell so builds are repeatable
+            if best_score is None or score > best_score or \
+                    (score == best_score and permutation[cell] < best_cell):
+                best_cell, best_score = permutation[cell], score
+            pending.append(after)
+        table[code] = best_cell
+    return table
+
+
+def write_table(table, path=TABLE_PATH):
+    """Writes the solved table as sorted fixed size records"""
+    with open(path, 'wb') as table_file:
+        for code in sorted(table):
+            table_file.write(RECORD.pack(code, table[code]))
+
+
+def load_table(path=TABLE_PATH):
+    """Reads the solved table written by write_table"""
+    with open(path, 'rb') as table_file:
+        data = table_file.read()
+    return dict(RECORD.unpack_from(data, offset)
+                for offset in range(0, len(data), RECORD.size))
+
+
+# Missing only while the table is being built for the first time
+TABLE = load_table() if os.path.exists(TABLE_PATH) else {}
+
+
+def best_move(x_mask, o_mask):
+    """Returns the cell the side to move should take"""
+    code, permutation = canonical(x_mask, o_mask)
+    return permutation.index(TABLE[code])
+
+
+if __name__ == '__main__':
+    write_table(solve())
@@ -1,15 +1,26 @@
 '''api.py - Contains all the api endpoints for playing the TicTacToe game'''
 
 import logging
+from datetime import datetime
 import endpoints
 from google.appengine.ext import ndb
-from protorpc import remote, messages
-from google.appengine.api import taskqueue
+from protorpc import remote, messages, protobuf
+from google.appengine.api import taskqueue, memcache
 
-from models import User, Game
+from models import User, Game, ScoreShard
 from models import NewGameForm, GameForm, StringMessage, MakeMoveForm
 from models import GameHistoryForm, UserForm, UserForms, GameForms
-from utils import get_by_urlsafe
+from models import MakeMovesForm, MakeMovesResultForm, ReplayGameForm
+from models import PositionStatsForm, MatchTicket, MatchTicketForm
+from utils import get_by_urlsafe, get_key_by_urlsafe, fetch_page
+from utils import get_key_by_name, get_entity, get_entities, local_cache
+from instrumentation import instrumented
+import ai
+import engine
+import leaderboard
+import matchmaking
+import openings
+import rules
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -17,10 +28,39 @@ GET_GAME_REQUEST = endpoints.ResourceContainer(
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(MakeMoveForm,
                                                 urlsafe_game_key=\
                                                 messages.StringField(1))
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm, urlsafe_game_key=messages.StringField(1))
+REPLAY_GAME_REQUEST = endpoints.ResourceContainer(ReplayGameForm)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 USERNAME_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, variant=messages.Variant.INT32),
+    cursor=messages.StringField(3))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1, variant=messages.Variant.INT32),
+    cursor=messages.StringField(2))
+USER_RANK_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    around=messages.IntegerField(2, variant=messages.Variant.INT32,
+                                 default=5))
+MATCH_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    skill_band=messages.BooleanField(2, default=False),
+    board_size=messages.IntegerField(3, variant=messages.Variant.INT32,
+                                     default=3),
+    win_length=messages.IntegerField(4, variant=messages.Variant.INT32,
+                                     default=3))
+
+# Largest board new_game accepts, as board_size x board_size
+MAX_BOARD_SIZE = 19
+# Seconds the history of an unfinished game is kept in the in-process cache
+HISTORY_CACHE_SECONDS = 60
+# Times a move is retried when a concurrent write to its game or players
+# makes the transaction fail
+MOVE_RETRIES = 5
 
 
 @endpoints.api(name='tictactoe', version='v1')
@@ -32,13 +72,14 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if request.user_name == User.AI_NAME or \
+                get_key_by_name(User, request.user_name):
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        User.create(request.user_name, request.email)
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -47,10 +88,27 @@ class TicTacToeApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
-        """Creates new game"""
-        player_x = User.query(User.name == request.player_x).get()
-        player_o = User.query(User.name == request.player_o).get()
+        """Creates new game. Set ai_side to 'X' or 'O' to play against the
+        computer, which then takes that side instead of a user"""
+        if request.ai_side not in (None, 'X', 'O'):
+            raise endpoints.BadRequestException('ai_side must be X or O')
+        self._check_not_ai(request.player_x, request.player_o)
+        self._check_board_shape(request.board_size, request.win_length)
+        if request.ai_side and (request.board_size, request.win_length) != \
+                (3, 3):
+            raise endpoints.BadRequestException(
+                'The computer only plays on the 3X3 board')
+        ai_key = request.ai_side and User.get_ai_user().key
+        if request.ai_side == 'X':
+            request.player_x = User.AI_NAME
+        elif request.ai_side == 'O':
+            request.player_o = User.AI_NAME
+        player_x = ai_key if request.ai_side == 'X' else \
+            get_key_by_name(User, request.player_x)
+        player_o = ai_key if request.ai_side == 'O' else \
+            get_key_by_name(User, request.player_o)
         if not player_x:
             raise endpoints.NotFoundException(
                 'A User with name {} does not \
@@ -62,14 +120,88 @@ class TicTacToeApi(remote.Service):
         if player_x == player_o:
             raise endpoints.BadRequestException('Game can be played by 2'
                                                 ' different players only.')
-        game = Game.new_game(player_x.key, player_o.key, request.player_x)
+        game = Game.new_game(player_x, player_o, request.player_x,
+                             request.ai_side, request.board_size,
+                             request.win_length)
+        if request.ai_side == 'X':
+            names = {player_x: request.player_x, player_o: request.player_o}
+            self.play_move(game, player_x, ai.best_move(0, 0), names)
+            game.put()
         return game.to_form('Good luck playing TicTacToe!')
 
+    @endpoints.method(request_message=MATCH_REQUEST,
+                      response_message=MatchTicketForm,
+                      path='matchmaking',
+                      name='join_matchmaking',
+                      http_method='POST')
+    @instrumented
+    def join_matchmaking(self, request):
+        """Puts the user in the matchmaking queue for a game of the given
+        board shape. With skill_band, the opponent is someone with a
+        similar win percent. Poll get_match_status to find the game."""
+        self._check_board_shape(request.board_size, request.win_length)
+        if request.user_name == User.AI_NAME:
+            raise endpoints.BadRequestException(
+                'The computer cannot join the matchmaking queue')
+        user_key = get_key_by_name(User, request.user_name)
+        user = user_key and get_entity(user_key)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        return matchmaking.join(user, request.board_size, request.win_length,
+                                request.skill_band).to_form()
+
+    @endpoints.method(request_message=USERNAME_REQUEST,
+                      response_message=MatchTicketForm,
+                      path='matchmaking/{user_name}',
+                      name='get_match_status',
+                      http_method='GET')
+    @instrumented
+    def get_match_status(self, request):
+        """Returns whether the user is still waiting for an opponent, or the
+        game they were put in. Reads only the user's ticket."""
+        ticket = MatchTicket.key_for(request.user_name).get()
+        if not ticket:
+            raise endpoints.NotFoundException(
+                'That user is not in the matchmaking queue')
+        return ticket.to_form()
+
+    @endpoints.method(request_message=USERNAME_REQUEST,
+                      response_message=StringMessage,
+                      path='matchmaking/{user_name}',
+                      name='leave_matchmaking',
+                      http_method='DELETE')
+    @instrumented
+    def leave_matchmaking(self, request):
+        """Takes a user who is still waiting out of the matchmaking
+        queue"""
+        if not matchmaking.leave(request.user_name):
+            raise endpoints.BadRequestException(
+                'That user is not waiting for a game')
+        return StringMessage(message='Left the matchmaking queue.')
+
+    def _check_not_ai(self, *names):
+        """Raises BadRequestException if a name is the computer's, which
+        only joins a game through ai_side"""
+        if User.AI_NAME in names:
+            raise endpoints.BadRequestException(
+                'Set ai_side to play against the computer')
+
+    def _check_board_shape(self, size, win_length):
+        """Raises BadRequestException unless new_game accepts the shape"""
+        if not 3 <= size <= MAX_BOARD_SIZE:
+            raise endpoints.BadRequestException(
+                'board_size should be within 3 to {}'.format(MAX_BOARD_SIZE))
+        if not 3 <= win_length <= size:
+            raise endpoints.BadRequestException(
+                'win_length should be within 3 to board_size')
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
         """Return the details of an ongoing game only """
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
@@ -79,46 +211,46 @@ class TicTacToeApi(remote.Service):
             raise endpoints.NotFoundException(
                 'Game not found or game already completed!')
 
-    @endpoints.method(request_message=USERNAME_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='game',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Returns the active games the user is associated with"""
-        user = User.query(User.name == request.user_name).get()
-        if user:
-            my_games = Game.query(ndb.AND(Game.game_over == False,
-                            Game.is_cancelled == False, ndb.OR(
-                            Game.player_x == user.key,
-                            Game.player_o == user.key))).fetch()
-            if my_games:
-                for game in my_games:
-                    return GameForms(items=[game.to_form(message= \
-                        "Active Game details") for game in my_games])
+        """Returns a page of the active games the user is associated with"""
+        user_key = get_key_by_name(User, request.user_name)
+        if user_key:
+            query = Game.query_user(user_key, Game.ACTIVE)
+            my_games, next_cursor = fetch_page(
+                query, request.page_size, request.cursor)
+            if my_games or request.cursor:
+                forms = Game.to_forms(my_games, "Active Game details")
+                forms.next_cursor = next_cursor
+                return forms
             else:
                 raise endpoints.NotFoundException(
                     'There are no active games for this user.')
         else:
             raise endpoints.NotFoundException('User does not exist')
 
-    @endpoints.method(request_message=USERNAME_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='get_user_completed_games',
                       name='get_user_completed_games',
                       http_method='GET')
+    @instrumented
     def get_user_completed_games(self, request):
-        """Returns the games the user has completed"""
-        user = User.query(User.name == request.user_name).get()
-        if user:
-            my_games = Game.query(ndb.AND(Game.game_over == True,
-                Game.is_cancelled == False, ndb.OR(
-                Game.player_x == user.key, Game.player_o == \
-                user.key))).fetch()
-            if my_games:
-                for game in my_games:
-                    return GameForms(items=[game.to_form(message=\
-                        "Completed Game details") for game in my_games])
+        """Returns a page of the games the user has completed"""
+        user_key = get_key_by_name(User, request.user_name)
+        if user_key:
+            query = Game.query_user(user_key, Game.COMPLETED)
+            my_games, next_cursor = fetch_page(
+                query, request.page_size, request.cursor)
+            if my_games or request.cursor:
+                forms = Game.to_forms(my_games, "Completed Game details")
+                forms.next_cursor = next_cursor
+                return forms
             else:
                 raise endpoints.NotFoundException(
                     'This user has not completed any game yet.')
@@ -130,166 +262,325 @@ class TicTacToeApi(remote.Service):
                       path='user_win_percent',
                       name='get_user_win_percent',
                       http_method='GET')
+    @instrumented
     def get_user_win_percent(self, request):
         """Returns the win percent of the given user"""
-        user = User.query(User.name == request.user_name).get()
+        user_key = get_key_by_name(User, request.user_name)
+        user = user_key and get_entity(user_key)
         if user:
-            print(user.name)
-            games_played = Game.query(ndb.AND(Game.game_over == True, ndb.OR(
-                Game.player_x == user.key, Game.player_o == \
-                user.key))).count()
-            games_won = Game.query(
-                ndb.AND(Game.game_over == True,
-                Game.winner == user.name)).count()
-            if games_played > 0:
+            if user.games_played > 0:
                 return StringMessage(message="Win Percentage is: \
-                    {}% ".format(
-                    games_won/float(games_played) * 100))
+                    {}% ".format(user.win_percent))
             else:
                 return StringMessage(message="User hasnt played \
                     any games yet")
         else:
             raise endpoints.NotFoundException('User does not exist')
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='get_user_ranking',
                       name='get_user_ranking',
                       http_method='GET')
+    @instrumented
     def get_user_ranking(self, request):
-        """Returns the ranking of all the users based on win percentage"""
-        return UserForms(users=[user.to_form() for user in \
-            User.query().order(-User.win_percent)])
+        """Returns a page of the users ranked by win percentage, ties
+        broken by games played"""
+        users, next_cursor = leaderboard.ranking_page(request.page_size,
+                                                      request.cursor)
+        return UserForms(users=users, next_cursor=next_cursor)
+
+    @endpoints.method(request_message=USER_RANK_REQUEST,
+                      response_message=UserForms,
+                      path='user_rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Returns the rank of the given user along with the users ranked
+        just above and below them"""
+        user_key = get_key_by_name(User, request.user_name)
+        user = user_key and get_entity(user_key)
+        if not user:
+            raise endpoints.NotFoundException('User does not exist')
+        if user.is_ai:
+            raise endpoints.BadRequestException(
+                'The computer is not on the leaderboard')
+        return UserForms(users=leaderboard.users_around(user,
+                                                        request.around))
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
-        """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Makes a move. Returns a game state with message. In a game
+        against the computer, its reply is made in the same request."""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        names = self._game_player_names(game_key)
+        game, message, _ = self._make_moves_txn(
+            game_key, names, self._move_list([request])).get_result()
+        return game.to_form(message, names)
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MakeMovesResultForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+        """Makes a list of moves in order, checked with the same rules as
+        make_move, and writes the game once. Returns the final game state
+        and the position (from 1) of the move that ended the game"""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        names = self._game_player_names(game_key)
+        game, message, ending_move = self._make_moves_txn(
+            game_key, names, self._move_list(request.moves)).get_result()
+        return MakeMovesResultForm(game=game.to_form(message, names),
+                                   ending_move=ending_move)
+
+    @endpoints.method(request_message=REPLAY_GAME_REQUEST,
+                      response_message=MakeMovesResultForm,
+                      path='game/replay',
+                      name='replay_game',
+                      http_method='POST')
+    @instrumented
+    def replay_game(self, request):
+        """Creates a game between two users and plays a list of moves in it,
+        writing it once. Returns the game state and the position (from 1)
+        of the move that ended the game"""
+        self._check_not_ai(request.player_x, request.player_o)
+        self._check_board_shape(request.board_size, request.win_length)
+        player_x = get_key_by_name(User, request.player_x)
+        player_o = get_key_by_name(User, request.player_o)
+        if not player_x or not player_o:
+            raise endpoints.NotFoundException(
+                'A User with name {} does not exist!'.format(
+                    request.player_o if player_x else request.player_x))
+        if player_x == player_o:
+            raise endpoints.BadRequestException('Game can be played by 2'
+                                                ' different players only.')
+        names = self._player_names([player_x, player_o])
+        game, message, ending_move = self._replay_game_txn(
+            player_x, player_o, names, request.board_size,
+            request.win_length, self._move_list(request.moves)).get_result()
+        return MakeMovesResultForm(game=game.to_form(message, names),
+                                   ending_move=ending_move)
+
+    def _move_list(self, moves):
+        """Returns (player key, move) pairs for a list of MakeMoveForms.
+        The computer's moves are only ever made by the api itself."""
+        if not moves:
+            raise endpoints.BadRequestException('No moves given')
+        keys = {}
+        for move in moves:
+            if move.player_name not in keys:
+                key = get_key_by_name(User, move.player_name)
+                if key and key.id() == User.AI_ID:
+                    raise endpoints.BadRequestException(
+                        'The computer makes its own moves')
+                keys[move.player_name] = key
+        return [(keys[move.player_name], move.move) for move in moves]
+
+    def _player_names(self, player_keys):
+        """Returns the names of users by key, read through the cache"""
+        return dict((user.key, user.name)
+                    for user in get_entities(player_keys) if user)
+
+    def _game_player_names(self, game_key):
+        """Returns the names of a game's players by key. The players of a
+        game never change, so they are read through the cache and outside
+        the move's transaction."""
+        game = get_entity(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return self._player_names([game.player_x, game.player_o])
+
+    @ndb.transactional_tasklet(xg=True, retries=MOVE_RETRIES)
+    def _make_moves_txn(self, game_key, names, moves):
+        """Reads, validates and writes the game and, when the moves end it,
+        the players' counters in one transaction. The players are only read
+        in it when the game ends, so moves in a player's other games do not
+        contend on their entity group. A concurrent move to the same game
+        makes the commit fail and the moves are retried against the new
+        state. names maps the game's player keys to their names. Returns
+        (game, message, position of the move that ended the game or
+        None)."""
+        game = yield game_key.get_async()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
-            return game.to_form('Game already over!')
+            raise ndb.Return(game, 'Game already over!', None)
         if game.is_cancelled:
-            return game.to_form('Sorry but this game has been cancelled.')
-
-        win_combinations = [
-            # horizontal
-            [0, 1, 2],
-            [3, 4, 5],
-            [6, 7, 8],
-            # vertical
-            [0, 3, 6],
-            [1, 4, 7],
-            [2, 5, 8],
-            # diagonal
-            [0, 4, 8],
-            [2, 4, 6]
-        ]
-
-        #Checking if the move input is valid
-        if request.move not in range(1, 10):
-            raise endpoints.BadRequestException(
-                'Wrong move. Move should be within 1 to 9')
-        history = {}
-        symbol = ''
-        game.number_of_moves += 1
-        # Checking if the spot is free to make a move
-        if game.board[request.move - 1] == '-':
-            if game.player_x.get().name == request.player_name:
-                symbol = 'X'
-                next_player = 'player_o'
-                current_player_key = game.player_x
-                indices, game = self.play_move(
-                    symbol, next_player, game, request)
-            elif game.player_o.get().name == request.player_name:
-                symbol = 'O'
-                next_player = 'player_x'
-                current_player_key = game.player_o
-                indices, game = self.play_move(
-                    symbol, next_player, game, request)
-            else:
+            raise ndb.Return(game, 'Sorry but this game has been cancelled.',
+                             None)
+        message, ending_move = yield self._play_moves_async(game, names,
+                                                            moves)
+        raise ndb.Return(game, message, ending_move)
+
+    @ndb.transactional_tasklet(xg=True)
+    def _replay_game_txn(self, player_x, player_o, names, size, win_length,
+                         moves):
+        """Creates the game and plays the moves in it in one transaction.
+        Returns the same as _make_moves_txn."""
+        game = Game(player_x=player_x, player_o=player_o,
+                    next_turn=names[player_x], size=size,
+                    win_length=win_length, created=datetime.utcnow())
+        message, ending_move = yield self._play_moves_async(game, names,
+                                                            moves)
+        raise ndb.Return(game, message, ending_move)
+
+    @ndb.tasklet
+    def _play_moves_async(self, game, names, moves):
+        """Plays (player key, move) pairs in order, each followed by the
+        computer's reply in a game against it, then writes the game, and
+        the players if the game ended. Returns (message, position of the
+        move that ended the game or None)."""
+        outcome = None
+        for position, (player_key, move) in enumerate(moves, 1):
+            if outcome:
                 raise endpoints.BadRequestException(
-                    'Your not a valid player for this game')
-
-            history['Player'] = symbol
-            history['Move'] = request.move
-            history['Result'] = "Move made"
-
-            # It takes minimum 5 moves for a person to win.
-            # Avoiding unnecessary checks by adding this condition
-            if game.number_of_moves >= 5:
-                # Looping through the win scenarios and checking for a match
-                for combination in win_combinations:
-                    if len(set(indices).intersection(combination)) == 3:
-                        game.winner = request.player_name
-                        game.next_turn = ""
-                        history['Result'] = "Win! Game Over."
-                        if current_player_key == game.player_x:
-                            game.history.append(history)
-                            game.end_game(
-                                current_player_key, game.player_o, True)
-                        else:
-                            game.history.append(history)
-                            game.end_game(
-                                game.player_o, current_player_key, True)
-                        return game.to_form('Congrats ! You have won!')
+                    'Game already over before move {}'.format(position))
+            outcome = self.play_move(game, player_key, move - 1, names)
+            message = 'Congrats ! You have won!'
+            if outcome is None and game.ai_side:
+                player_key = game.player(game.ai_side)
+                outcome = self.play_move(
+                    game, player_key, ai.best_move(game.mask('X'),
+                                                   game.mask('O')), names)
+                message = 'The computer has won!'
 
+        if outcome == engine.WON:
+            yield self._end_game_async(game, player_key,
+                                       game.opponent(player_key), True)
+            raise ndb.Return(message, position)
+        if outcome == engine.TIED:
+            yield self._end_game_async(game, game.player_x, game.player_o,
+                                       False)
         else:
-            raise endpoints.BadRequestException(
-                'Illegal move. That move has already been made')
-
-        # Checking for the last move in the game.
-        # If the game has reached the last move and hasnt matched a winning
-        # combination above, then its a tie
-        if game.number_of_moves == 9:
-            game.message = "Game over. It was a tie!"
-            history['Result'] = "Game over. It was a tie!"
-            game.next_turn = ""
-            game.end_game(game.player_x, game.player_o, False)
-
-        game.history.append(history)
-        game.put()
-        return game.to_form('Come on,You can do this!Give it your best shot!')
-
-    def play_move(self, symbol, next_player, game, request):
-        '''Mark the board with X or O appropriately'''
-        if game.next_turn == request.player_name:
-            game.board[request.move - 1] = symbol
-            # finding out the indices where the player has made all his moves
-            indices = [i for i, j in enumerate(game.board) if j == symbol]
-            next_player_key = getattr(game, next_player)
-            game.next_turn = next_player_key.get().name
-            return indices, game
+            yield game.put_async()
+        raise ndb.Return('Come on,You can do this!Give it your best shot!',
+                         position if outcome else None)
+
+    @ndb.tasklet
+    def _end_game_async(self, game, winner_key, loser_key, won):
+        """Ends the game and writes it with the human players and the
+        leaderboard shards they move between. The players are read here,
+        in the move's transaction. Classic games are also enqueued to be
+        counted in the opening book."""
+        winner, loser = yield ndb.get_multi_async([winner_key, loser_key])
+        players = [user for user in (winner, loser) if not user.is_ai]
+        old_scores = [user.rank_score for user in players]
+        game.end_game(winner, loser, won)
+        shards = yield ScoreShard.update_async(
+            zip(old_scores, [user.rank_score for user in players]))
+        yield ndb.put_multi_async([game] + players + shards)
+        if openings.is_classic(game):
+            yield openings.enqueue_async(game)
+
+    def play_move(self, game, player_key, cell, names):
+        '''Mark the board with X or O appropriately. names maps the game's
+        player keys to their names. Returns engine.WON or engine.TIED if the
+        move ended the game, otherwise None'''
+        if player_key == game.player_x:
+            symbol = 'X'
+        elif player_key == game.player_o:
+            symbol = 'O'
         else:
-            raise endpoints.BadRequestException('This is not your turn!')
+            symbol = None
+        to_move = 'X' if game.next_turn == names[game.player_x] else 'O'
+        try:
+            rules.check_move(game.mask('X'), game.mask('O'), symbol, to_move,
+                             cell, game.cells)
+        except rules.IllegalMove as e:
+            raise endpoints.BadRequestException(str(e))
+
+        game.number_of_moves += 1
+        # bitmask of all the cells the player has moved on
+        mask = game.add_move(symbol, cell)
+        result = rules.result(mask, cell, game.number_of_moves, game.size,
+                              game.win_length)
+        if result == engine.WON:
+            game.winner = names[player_key]
+        game.next_turn = "" if result else names[game.opponent(player_key)]
+        return result
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameHistoryForm,
                       path='games/game_history',
                       name='game_history',
                       http_method='GET')
+    @instrumented
     def game_history(self, request):
-        '''Returns the game history '''
+        '''Returns the game history, one entry per move. A finished game never
+        changes, so its history is cached without expiry and served without
+        reading the game; other games are cached per number of moves.'''
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        final_key = 'history:final:{}'.format(game_key.urlsafe())
+        form = local_cache.get(final_key)
+        if form is None:
+            data = memcache.get(final_key)
+            if data:
+                form = protobuf.decode_message(GameHistoryForm, data)
+                local_cache.set(final_key, form)
+        if form is not None:
+            return form
+        game = get_entity(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            form = game.to_history_form()
+            memcache.set(final_key, protobuf.encode_message(form))
+            local_cache.set(final_key, form)
+            return form
+        version_key = ('history', game_key, game.number_of_moves)
+        form = local_cache.get(version_key)
+        if form is None:
+            form = game.to_history_form()
+            local_cache.set(version_key, form, HISTORY_CACHE_SECONDS)
+        return form
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=PositionStatsForm,
+                      path='game/{urlsafe_game_key}/stats',
+                      name='get_position_stats',
+                      http_method='GET')
+    @instrumented
+    def get_position_stats(self, request):
+        """Returns how often the game's current position occurred in
+        finished games and how each free move turned out for the side
+        making it. 3 x 3 games only."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        return GameHistoryForm(game_history=','.join(str(element) \
-            for element in game.history))
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return openings.position_stats(game)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='games/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
     def cancel_game(self, request):
         '''Cancels an ongoing game. Cannot cancel completed games'''
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if not game.game_over:
-            game.is_cancelled = True
-            game.put()
-            return StringMessage(message='The game is cancelled.')
-        else:
+        self._cancel_game_txn(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
+        return StringMessage(message='The game is cancelled.')
+
+    @ndb.transactional(retries=MOVE_RETRIES)
+    def _cancel_game_txn(self, game_key):
+        """Reads, checks and writes the game in one transaction, so a move
+        ending the game at the same time is never overwritten"""
+        game = game_key.get()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
             raise endpoints.BadRequestException('Sorry, cannot cancel' +
                                                 ' completed games.')
+        game.is_cancelled = True
+        game.put()
 
 
 api = endpoints.api_server([TicTacToeApi])
@@ -0,0 +1,85 @@
+"""bench_ai.py - Checks the precomputed AI table against an exhaustive search
+and measures how long it takes to load and how much memory it holds.
+
+Every reachable position is searched again from scratch, without symmetry
+reduction, and the move from the table must reach the best score there.
+
+Run from the repository root:
+    python benchmarks/bench_ai.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import ai
+import engine
+
+
+def search(x_mask, o_mask, scores):
+    """Exhaustive minimax score of the position for the side to move, using
+    the same scoring as ai._negamax. scores memoizes plain positions."""
+    if (x_mask, o_mask) in scores:
+        return scores[(x_mask, o_mask)]
+    x_to_move = bin(x_mask).count('1') == bin(o_mask).count('1')
+    empty = engine.FULL_BOARD & ~(x_mask | o_mask)
+    if engine.is_win(o_mask if x_to_move else x_mask):
+        score = -1 - bin(empty).count('1')
+    elif not empty:
+        score = 0
+    else:
+        score = max(-search(*after(x_mask, o_mask, x_to_move, cell),
+                            scores=scores)
+                    for cell in range(9) if empty >> cell & 1)
+    scores[(x_mask, o_mask)] = score
+    return score
+
+
+def after(x_mask, o_mask, x_to_move, cell):
+    """Returns the masks after the side to move takes cell"""
+    if x_to_move:
+        return x_mask | 1 << cell, o_mask
+    return x_mask, o_mask | 1 << cell
+
+
+def verify():
+    """Returns the number of positions checked, raising on any mismatch"""
+    scores = {}
+    search(0, 0, scores)
+    checked = 0
+    for (x_mask, o_mask), score in scores.items():
+        if engine.is_win(x_mask) or engine.is_win(o_mask) or \
+                engine.is_full(x_mask, o_mask):
+            continue
+        x_to_move = bin(x_mask).count('1') == bin(o_mask).count('1')
+        cell = ai.best_move(x_mask, o_mask)
+        assert engine.is_free(x_mask, o_mask, cell), (x_mask, o_mask)
+        child = after(x_mask, o_mask, x_to_move, cell)
+        assert -scores[child] == score, (x_mask, o_mask, cell)
+        checked += 1
+    return checked
+
+
+def table_bytes(table):
+    """Approximate memory held by the loaded table"""
+    return sys.getsizeof(table) + sum(
+        sys.getsizeof(code) + sys.getsizeof(cell)
+        for code, cell in table.items())
+
+
+def main():
+    print('positions verified: {}'.format(verify()))
+    print('table entries:      {}'.format(len(ai.TABLE)))
+    print('table file bytes:   {}'.format(os.path.getsize(ai.TABLE_PATH)))
+    print('table memory bytes: {}'.format(table_bytes(ai.TABLE)))
+    seconds = min(timeit.repeat(ai.load_table, repeat=5, number=10)) / 10
+    print('table load time:    {:.2f} ms'.format(seconds * 1000))
+    seconds = min(timeit.repeat(lambda: ai.best_move(0b000010001, 0b100000),
+                                repeat=5, number=10000)) / 10000
+    print('move lookup time:   {:.1f} us'.format(seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
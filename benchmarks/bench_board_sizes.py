@@ -0,0 +1,64 @@
+"""bench_board_sizes.py - Measures the cost of a move (place plus win check)
+on boards of growing size. The check after a move only looks at the lines
+through it, so its cost should stay flat while a scan of every line on the
+board grows with the board.
+
+Run from the repository root:
+    python benchmarks/bench_board_sizes.py [number_of_games]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import engine
+
+SHAPES = ((3, 3), (7, 5), (11, 5), (15, 5), (19, 5))
+
+
+def play(games, size, win_length, full_scan=False):
+    """Plays the move orders and returns (moves made, seconds taken)"""
+    moves_made = 0
+    start = time.time()
+    for moves in games:
+        masks = [0, 0]
+        for number, cell in enumerate(moves):
+            side = number % 2
+            masks[side] = engine.place(masks[side], cell)
+            moves_made += 1
+            if full_scan:
+                won = engine.is_win(masks[side], size, win_length)
+            else:
+                won = engine.is_winning_move(masks[side], cell, size,
+                                             win_length)
+            if won:
+                break
+    return moves_made, time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = random.Random(0)
+    print('{:>7} {:>6} {:>14} {:>14}'.format(
+        'board', 'lines', 'us/move', 'full scan'))
+    for size, win_length in SHAPES:
+        engine.lines(size, win_length)
+        games = []
+        for _ in range(count):
+            cells = list(range(size * size))
+            rng.shuffle(cells)
+            games.append(cells)
+        moves, seconds = play(games, size, win_length)
+        scan_moves, scan_seconds = play(games[:max(count // 20, 1)], size,
+                                        win_length, full_scan=True)
+        print('{:>7} {:>6} {:>14.2f} {:>14.2f}'.format(
+            '{0}x{0}/{1}'.format(size, win_length),
+            len(engine.lines(size, win_length)[0]),
+            seconds / moves * 1e6, scan_seconds / scan_moves * 1e6))
+
+
+if __name__ == '__main__':
+    main()
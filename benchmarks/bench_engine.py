@@ -0,0 +1,78 @@
+"""bench_engine.py - Micro-benchmark comparing the bitboard win check in
+engine.py with the list/set based check make_move used before it.
+
+Run from the repository root:
+    python benchmarks/bench_engine.py [number_of_games]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import engine
+
+
+def random_games(count, seed=0):
+    """Returns count random move orders (cells 0 to 8)"""
+    rng = random.Random(seed)
+    games = []
+    for _ in range(count):
+        cells = list(range(9))
+        rng.shuffle(cells)
+        games.append(cells)
+    return games
+
+
+def replay_legacy(games):
+    """Replays the games with the set-intersection check"""
+    wins = 0
+    for moves in games:
+        win_combinations = [
+            [0, 1, 2], [3, 4, 5], [6, 7, 8],
+            [0, 3, 6], [1, 4, 7], [2, 5, 8],
+            [0, 4, 8], [2, 4, 6]
+        ]
+        board = ['-'] * 9
+        for number, cell in enumerate(moves, 1):
+            symbol = 'X' if number % 2 else 'O'
+            board[cell] = symbol
+            indices = [i for i, j in enumerate(board) if j == symbol]
+            if number >= 5 and any(
+                    len(set(indices).intersection(combination)) == 3
+                    for combination in win_combinations):
+                wins += 1
+                break
+    return wins
+
+
+def replay_engine(games):
+    """Replays the games with the bitboard check"""
+    wins = 0
+    for moves in games:
+        masks = [0, 0]
+        for number, cell in enumerate(moves, 1):
+            side = number % 2
+            masks[side] = engine.place(masks[side], cell)
+            if number >= 5 and engine.is_winning_move(masks[side], cell):
+                wins += 1
+                break
+    return wins
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    games = random_games(count)
+    assert replay_legacy(games) == replay_engine(games)
+    for name, replay in (('legacy', replay_legacy),
+                         ('engine', replay_engine)):
+        seconds = min(timeit.repeat(lambda: replay(games),
+                                    repeat=3, number=1))
+        print('{:<8} {:>8.3f}s  {:>10.0f} games/s'.format(
+            name, seconds, count / seconds))
+
+
+if __name__ == '__main__':
+    main()
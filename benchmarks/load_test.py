@@ -0,0 +1,271 @@
+"""load_test.py - Load test and benchmark of the TicTacToeApi endpoints.
+
+Boots TicTacToeApi in-process against the App Engine testbed's in-memory
+datastore, memcache and task queue stubs, seeds users and games, then drives
+a weighted mix of endpoint calls. For every endpoint it reports call and
+error counts, p50/p95/p99 latency, datastore and memcache RPCs per call and
+the growth of the process' peak memory. Results are written as JSON so runs
+can be compared across changes.
+
+Needs the App Engine Python SDK (Python 2.7). Point APPENGINE_SDK at its
+root (the directory holding dev_appserver.py) and run from the repository
+root:
+    python benchmarks/load_test.py [--users 50] [--calls 2000] [--seed 0]
+                                   [--output results.json]
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Relative weights of the endpoints in the mixed phase
+TRAFFIC_MIX = (
+    ('make_move', 40),
+    ('get_game', 15),
+    ('get_user_games', 10),
+    ('new_game', 8),
+    ('get_user_completed_games', 7),
+    ('game_history', 7),
+    ('get_user_win_percent', 6),
+    ('get_user_ranking', 5),
+    ('create_user', 2),
+)
+
+
+def setup_sdk():
+    """Puts the App Engine SDK and the app on sys.path"""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if not sdk:
+        sys.exit('Set APPENGINE_SDK to the App Engine Python SDK root')
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+class RpcCounter(object):
+
+    """Counts the API calls made through the apiproxy, by service"""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def __call__(self, service, call, request, response):
+        self.counts[service] += 1
+
+    def reset(self):
+        self.counts.clear()
+
+
+class LoadTest(object):
+
+    """Drives the endpoints and records a sample per call"""
+
+    def __init__(self, seed):
+        from api import (TicTacToeApi, USER_REQUEST, NEW_GAME_REQUEST,
+                         GET_GAME_REQUEST, MAKE_MOVE_REQUEST,
+                         USERNAME_REQUEST, USER_GAMES_REQUEST, PAGE_REQUEST)
+        from google.appengine.api import apiproxy_stub_map
+        self.api = TicTacToeApi()
+        self.requests = {
+            'create_user': USER_REQUEST,
+            'new_game': NEW_GAME_REQUEST,
+            'get_game': GET_GAME_REQUEST,
+            'make_move': MAKE_MOVE_REQUEST,
+            'game_history': GET_GAME_REQUEST,
+            'get_user_win_percent': USERNAME_REQUEST,
+            'get_user_games': USER_GAMES_REQUEST,
+            'get_user_completed_games': USER_GAMES_REQUEST,
+            'get_user_ranking': PAGE_REQUEST,
+        }
+        self.rng = random.Random(seed)
+        self.rpcs = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'load_test', self.rpcs)
+        self.samples = collections.defaultdict(list)
+        self.users = []
+        # urlsafe keys of the games still being played
+        self.active_games = set()
+        self.games = []
+
+    def call(self, endpoint, **fields):
+        """Calls the endpoint as a fresh request would and records it.
+        Returns the response, or None if the endpoint raised"""
+        from google.appengine.ext import ndb
+        ndb.get_context().clear_cache()
+        request = self.requests[endpoint].combined_message_class(**fields)
+        self.rpcs.reset()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        try:
+            response = getattr(self.api, endpoint)(request)
+            error = None
+        except Exception as e:
+            response = None
+            error = e.__class__.__name__
+        elapsed = time.time() - start
+        self.samples[endpoint].append({
+            'ms': elapsed * 1000,
+            'error': error,
+            'datastore_rpcs': self.rpcs.counts['datastore_v3'],
+            'memcache_rpcs': self.rpcs.counts['memcache'],
+            'rss_growth_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss - rss,
+        })
+        return response
+
+    def create_user(self):
+        name = 'user{}'.format(len(self.users))
+        if self.call('create_user', user_name=name,
+                     email='{}@example.com'.format(name)):
+            self.users.append(name)
+
+    def new_game(self):
+        player_x, player_o = self.rng.sample(self.users, 2)
+        form = self.call('new_game', player_x=player_x, player_o=player_o)
+        if form:
+            self.active_games.add(form.urlsafe_key)
+            self.games.append(form.urlsafe_key)
+            return form.urlsafe_key
+
+    def make_move(self, key=None):
+        """Fetches a game and plays a random free cell as the player whose
+        turn it is"""
+        if not self.active_games:
+            return self.new_game()
+        key = key or self.rng.choice(sorted(self.active_games))
+        game = self.call('get_game', urlsafe_game_key=key)
+        if not game:
+            self.active_games.discard(key)
+            return
+        free = [cell + 1 for cell, value in enumerate(game.board.split(','))
+                if value == '-']
+        form = self.call('make_move', urlsafe_game_key=key,
+                         player_name=game.next_turn,
+                         move=self.rng.choice(free))
+        if form is None or form.game_over:
+            self.active_games.discard(key)
+
+    def play_full_game(self):
+        key = self.new_game()
+        while key in self.active_games:
+            self.make_move(key)
+
+    def random_user(self):
+        return self.rng.choice(self.users)
+
+    def random_game(self):
+        return self.rng.choice(self.games)
+
+    def mixed_call(self, endpoint):
+        """Makes one call of the mixed phase to the endpoint"""
+        if endpoint == 'make_move':
+            self.make_move()
+        elif endpoint == 'new_game':
+            self.new_game()
+        elif endpoint == 'create_user':
+            self.create_user()
+        elif endpoint in ('get_game', 'game_history'):
+            self.call(endpoint, urlsafe_game_key=self.random_game())
+        elif endpoint in ('get_user_games', 'get_user_completed_games',
+                          'get_user_win_percent'):
+            self.call(endpoint, user_name=self.random_user())
+        elif endpoint == 'get_user_ranking':
+            self.call(endpoint)
+
+    def run(self, users, full_games, calls):
+        """Seeds users and finished games, opens a game per user, then makes
+        the mixed calls"""
+        for _ in range(users):
+            self.create_user()
+        for _ in range(full_games):
+            self.play_full_game()
+        for _ in range(users):
+            self.new_game()
+        endpoints = [endpoint for endpoint, weight in TRAFFIC_MIX
+                     for _ in range(weight)]
+        for _ in range(calls):
+            self.mixed_call(self.rng.choice(endpoints))
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(samples):
+    """Returns the per endpoint report"""
+    report = {}
+    for endpoint, calls in sorted(samples.items()):
+        latencies = sorted(call['ms'] for call in calls)
+        report[endpoint] = {
+            'calls': len(calls),
+            'errors': sum(1 for call in calls if call['error']),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'datastore_rpcs_per_call': sum(
+                call['datastore_rpcs'] for call in calls) / float(len(calls)),
+            'memcache_rpcs_per_call': sum(
+                call['memcache_rpcs'] for call in calls) / float(len(calls)),
+            'rss_growth_kb': sum(call['rss_growth_kb'] for call in calls),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--games', type=int, default=20,
+                        help='full games played through before the mix')
+    parser.add_argument('--calls', type=int, default=2000,
+                        help='calls in the mixed phase')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file (default: stdout)')
+    args = parser.parse_args()
+
+    setup_sdk()
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    try:
+        test = LoadTest(args.seed)
+        start = time.time()
+        test.run(args.users, args.games, args.calls)
+        results = {
+            'config': vars(args),
+            'seconds': time.time() - start,
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            'endpoints': summarize(test.samples),
+        }
+    finally:
+        bed.deactivate()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""reminder_test.py - Testbed run of the hourly reminder emails.
+
+Seeds users and games through TicTacToeApi against the App Engine testbed's
+in-memory datastore, task queue and mail stubs, with each user in games on
+several pages. It then calls the reminder cron and runs the tasks it enqueues
+until the queue is empty. Checks that every user with an email and an active
+game is sent exactly one reminder, and that users left only with cancelled
+games, users without an email and the computer are sent none. The cron is
+then called again within the same run, which must send nothing. It reports
+the timing, task, taskqueue RPC and email counts of each run as JSON and
+exits non-zero if a check fails.
+
+Needs the App Engine Python SDK (Python 2.7). Point APPENGINE_SDK at its
+root (the directory holding dev_appserver.py) and run from the repository
+root:
+    python benchmarks/reminder_test.py [--users 60] [--games 300]
+                                       [--batch-size 10] [--seed 0]
+"""
+
+import argparse
+import collections
+import json
+import random
+import sys
+import time
+
+from load_test import ROOT, RpcCounter, setup_sdk
+
+
+def seed(rng, users, games):
+    """Creates the users and games. Returns the emails that should get a
+    reminder."""
+    from api import (TicTacToeApi, USER_REQUEST, NEW_GAME_REQUEST,
+                     GET_GAME_REQUEST)
+    api = TicTacToeApi()
+    emails = {}
+    for index in range(users):
+        name = 'user{}'.format(index)
+        # Every fifth user has no email
+        email = '{}@example.com'.format(name) if index % 5 else None
+        api.create_user(USER_REQUEST.combined_message_class(
+            user_name=name, email=email))
+        emails[name] = email
+
+    expected = set()
+    names = sorted(emails)
+    for index in range(games):
+        if index % 10 == 0:
+            fields = {'player_x': rng.choice(names), 'ai_side': 'O'}
+        else:
+            player_x, player_o = rng.sample(names, 2)
+            fields = {'player_x': player_x, 'player_o': player_o}
+        form = api.new_game(NEW_GAME_REQUEST.combined_message_class(**fields))
+        if index % 7 == 0:
+            api.cancel_game(GET_GAME_REQUEST.combined_message_class(
+                urlsafe_game_key=form.urlsafe_key))
+            continue
+        for name in (fields.get('player_x'), fields.get('player_o')):
+            if name and emails[name]:
+                expected.add(emails[name])
+    return expected
+
+
+def run_queue(stub, app):
+    """Runs the queued tasks, and those they enqueue, until the queue is
+    empty. Returns the tasks run per url."""
+    import webapp2
+    counts = collections.Counter()
+    while True:
+        tasks = stub.get_filtered_tasks(queue_names=['default'])
+        if not tasks:
+            return counts
+        for task in tasks:
+            stub.DeleteTask('default', task.name)
+            response = webapp2.Request.blank(
+                task.url, POST=task.extract_params()).get_response(app)
+            if response.status_int != 200:
+                sys.exit('Task {} failed: {}'.format(task.url,
+                                                     response.status))
+            counts[task.url] += 1
+
+
+def reminder_run(bed, app, rpcs, batch_size):
+    """Calls the reminder cron and runs its tasks. Returns the run's report
+    and the recipients of the emails it sent."""
+    from google.appengine.ext import testbed
+    mail_stub = bed.get_stub(testbed.MAIL_SERVICE_NAME)
+    sent_before = len(mail_stub.get_sent_messages())
+    rpcs.reset()
+    start = time.time()
+    response = app.get_response('/crons/send_reminder?batch_size={}'.format(
+        batch_size))
+    if response.status_int != 200:
+        sys.exit('Cron failed: {}'.format(response.status))
+    tasks = run_queue(bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME), app)
+    recipients = [message.to for message in
+                  mail_stub.get_sent_messages()[sent_before:]]
+    return {
+        'seconds': time.time() - start,
+        'page_tasks': tasks['/tasks/send_reminder_page'],
+        'batch_tasks': tasks['/tasks/send_reminders'],
+        'emails': len(recipients),
+        'distinct_recipients': len(set(recipients)),
+        'taskqueue_rpcs': rpcs.counts['taskqueue'],
+        'datastore_rpcs': rpcs.counts['datastore_v3'],
+        'memcache_rpcs': rpcs.counts['memcache'],
+    }, recipients
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=60)
+    parser.add_argument('--games', type=int, default=300)
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help='active games read per page task and users '
+                        'per batch task')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    setup_sdk()
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    failures = []
+    try:
+        from google.appengine.api import apiproxy_stub_map
+        from main import app
+        rpcs = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'reminder_test', rpcs)
+        expected = seed(random.Random(args.seed), args.users, args.games)
+        first, recipients = reminder_run(bed, app, rpcs, args.batch_size)
+        duplicates = sorted(email for email, count in
+                            collections.Counter(recipients).items()
+                            if count > 1)
+        if duplicates:
+            failures.append('sent more than once: {}'.format(duplicates))
+        if set(recipients) != expected:
+            failures.append('missing: {}, unexpected: {}'.format(
+                sorted(expected - set(recipients)),
+                sorted(set(recipients) - expected)))
+        second, recipients = reminder_run(bed, app, rpcs, args.batch_size)
+        if recipients:
+            failures.append('second call of the run sent {} emails'.format(
+                len(recipients)))
+    finally:
+        bed.deactivate()
+
+    print(json.dumps({
+        'config': vars(args),
+        'expected_recipients': len(expected),
+        'runs': [first, second],
+        'failures': failures,
+    }, indent=2, sort_keys=True))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
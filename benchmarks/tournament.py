@@ -0,0 +1,147 @@
+"""tournament.py - Self-play tournament between move strategies.
+
+Plays games between two strategies over a pool of processes, checking every
+move with the same rules the API uses (rules.py), and reports the X win, O
+win and draw rates and the games played per second. Runs with the same seed
+give the same results, so a change to the rules or the engine that changes
+any outcome shows up as a change in the rates.
+
+Strategies:
+    random: any free cell
+    heuristic: wins if it can, otherwise blocks, otherwise takes the centre,
+        otherwise a random free cell
+    perfect: the solved table of ai.py (3 x 3 boards only)
+
+Run from the repository root:
+    python benchmarks/tournament.py [--x perfect] [--o random]
+                                    [--games 100000] [--size 3]
+                                    [--win-length 3] [--processes N]
+                                    [--seed 0]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import ai
+import engine
+import rules
+
+# Games played per task handed to a worker process
+CHUNK_SIZE = 1000
+
+
+def _free_cells(x_mask, o_mask, cells):
+    return [cell for cell in range(cells) if engine.is_free(x_mask, o_mask,
+                                                            cell)]
+
+
+def random_move(x_mask, o_mask, symbol, size, win_length, rng):
+    return rng.choice(_free_cells(x_mask, o_mask, size * size))
+
+
+def heuristic_move(x_mask, o_mask, symbol, size, win_length, rng):
+    free = _free_cells(x_mask, o_mask, size * size)
+    mine, theirs = (x_mask, o_mask) if symbol == 'X' else (o_mask, x_mask)
+    for mask in (mine, theirs):
+        for cell in free:
+            if engine.is_winning_move(engine.place(mask, cell), cell, size,
+                                      win_length):
+                return cell
+    centre = size * size // 2
+    if size % 2 and centre in free:
+        return centre
+    return rng.choice(free)
+
+
+def perfect_move(x_mask, o_mask, symbol, size, win_length, rng):
+    return ai.best_move(x_mask, o_mask)
+
+
+STRATEGIES = {
+    'random': random_move,
+    'heuristic': heuristic_move,
+    'perfect': perfect_move,
+}
+
+
+def play_game(strategies, size, win_length, rng):
+    """Plays one game and returns the winning symbol, or None for a tie"""
+    x_mask = o_mask = 0
+    for number in range(size * size):
+        symbol = 'XO'[number % 2]
+        cell = strategies[symbol](x_mask, o_mask, symbol, size, win_length,
+                                  rng)
+        rules.check_move(x_mask, o_mask, symbol, symbol, cell, size * size)
+        if symbol == 'X':
+            x_mask = mask = engine.place(x_mask, cell)
+        else:
+            o_mask = mask = engine.place(o_mask, cell)
+        result = rules.result(mask, cell, number + 1, size, win_length)
+        if result == engine.WON:
+            return symbol
+        if result == engine.TIED:
+            return None
+
+
+def play_chunk(args):
+    """Plays one chunk of games with its own seed. Returns the number of X
+    wins, O wins and ties."""
+    x_name, o_name, size, win_length, games, seed = args
+    strategies = {'X': STRATEGIES[x_name], 'O': STRATEGIES[o_name]}
+    rng = random.Random(seed)
+    counts = {'X': 0, 'O': 0, None: 0}
+    for _ in range(games):
+        counts[play_game(strategies, size, win_length, rng)] += 1
+    return counts['X'], counts['O'], counts[None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--x', choices=sorted(STRATEGIES), default='perfect')
+    parser.add_argument('--o', choices=sorted(STRATEGIES), default='random')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--win-length', type=int, default=3)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if 'perfect' in (args.x, args.o) and (args.size, args.win_length) != \
+            (3, 3):
+        parser.error('the perfect strategy only plays 3 x 3 boards')
+    if not 3 <= args.win_length <= args.size:
+        parser.error('win length should be within 3 to size')
+
+    chunks = [(args.x, args.o, args.size, args.win_length,
+               min(CHUNK_SIZE, args.games - start), args.seed + index)
+              for index, start in enumerate(range(0, args.games,
+                                                  CHUNK_SIZE))]
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        results = pool.map(play_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    x_wins, o_wins, ties = [sum(column) for column in zip(*results)]
+    print('{} (X) vs {} (O), {} x {} board, {} in a row, {} processes'.format(
+        args.x, args.o, args.size, args.size, args.win_length,
+        args.processes))
+    for label, count in (('X wins', x_wins), ('O wins', o_wins),
+                         ('Draws', ties)):
+        print('{:8} {:>10} {:7.2%}'.format(label, count,
+                                          count / float(args.games)))
+    print('{} games in {:.2f}s, {:.0f} games/s'.format(
+        args.games, elapsed, args.games / elapsed))
+
+
+if __name__ == '__main__':
+    main()
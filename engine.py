@@ -0,0 +1,160 @@
+"""engine.py - Bitboard engine for the TicTacToe board. Each side's position
+is an integer bitmask in which bit i is set when that side holds cell i.
+Cells are numbered from 0, left to right, top to bottom, so the API's move
+number n is cell n - 1.
+
+Boards are size x size and a game is won by win_length cells in a row. Both
+default to the classic 3 x 3 board, three in a row."""
+
+import binascii
+
+EMPTY = '-'
+
+# Outcomes of a move that ends the game
+WON = 'won'
+TIED = 'tied'
+
+# Line directions as (row step, column step)
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+# Histories of boards with more cells than this use two bytes per move
+SMALL_BOARD_CELLS = 16
+
+# A packed move history holds one byte per move on small boards: the cell
+# in the low four bits, with O_MOVE set when O made the move. Larger boards
+# use two bytes per move, big-endian, with O_MOVE_WIDE as the flag.
+O_MOVE = 0x10
+CELL_BITS = 0x0f
+O_MOVE_WIDE = 0x8000
+CELL_BITS_WIDE = 0x7fff
+
+_lines = {}
+
+
+def lines(size=3, win_length=3):
+    """Returns (win_masks, lines_through) for a board shape: every run of
+    win_length cells as a mask, and for each cell the runs through it.
+    Only the runs through a move can have been completed by it, so the win
+    check after a move costs the same whatever the size of the board.
+    Computed once per board shape."""
+    if (size, win_length) not in _lines:
+        win_masks = []
+        lines_through = [[] for _ in range(size * size)]
+        for row in range(size):
+            for col in range(size):
+                for d_row, d_col in DIRECTIONS:
+                    end_row = row + d_row * (win_length - 1)
+                    end_col = col + d_col * (win_length - 1)
+                    if not (end_row < size and 0 <= end_col < size):
+                        continue
+                    cells = [(row + d_row * step) * size + col + d_col * step
+                             for step in range(win_length)]
+                    line = 0
+                    for cell in cells:
+                        line |= 1 << cell
+                    win_masks.append(line)
+                    for cell in cells:
+                        lines_through[cell].append(line)
+        _lines[(size, win_length)] = (
+            tuple(win_masks),
+            tuple(tuple(through) for through in lines_through))
+    return _lines[(size, win_length)]
+
+
+# Every line that wins the classic game, as a mask of the three cells on it,
+# and the winning lines that pass through each cell.
+WIN_MASKS, LINES_THROUGH = lines()
+
+FULL_BOARD = 0b111111111
+
+
+def full_board(size=3):
+    """Returns the mask with every cell of the board set"""
+    return (1 << size * size) - 1
+
+
+def place(mask, cell):
+    """Returns the mask with the given cell added"""
+    return mask | (1 << cell)
+
+
+def is_free(x_mask, o_mask, cell):
+    """Returns True if neither side holds the given cell"""
+    return not (x_mask | o_mask) >> cell & 1
+
+
+def is_win(mask, size=3, win_length=3):
+    """Returns True if the mask holds any complete line. This looks at every
+    line on the board; after a move use is_winning_move instead."""
+    for line in lines(size, win_length)[0]:
+        if mask & line == line:
+            return True
+    return False
+
+
+def is_winning_move(mask, cell, size=3, win_length=3):
+    """Returns True if the mask holds a complete line through the cell. The
+    mask is expected to already include the cell."""
+    for line in lines(size, win_length)[1][cell]:
+        if mask & line == line:
+            return True
+    return False
+
+
+def is_full(x_mask, o_mask, size=3):
+    """Returns True if every cell on the board is taken"""
+    return x_mask | o_mask == full_board(size)
+
+
+def mask_from_board(board, symbol):
+    """Returns the mask of the cells holding symbol in a list board"""
+    mask = 0
+    for cell, value in enumerate(board):
+        if value == symbol:
+            mask |= 1 << cell
+    return mask
+
+
+def board_from_masks(x_mask, o_mask, size=3):
+    """Returns the list board ('X', 'O' or '-' per cell) for two masks"""
+    board = []
+    for cell in range(size * size):
+        if x_mask >> cell & 1:
+            board.append('X')
+        elif o_mask >> cell & 1:
+            board.append('O')
+        else:
+            board.append(EMPTY)
+    return board
+
+
+def mask_to_bytes(mask):
+    """Returns the big-endian bytes of a mask"""
+    digits = '%x' % mask
+    return binascii.unhexlify('0' * (len(digits) % 2) + digits)
+
+
+def mask_from_bytes(data):
+    """Returns the mask encoded by mask_to_bytes"""
+    return int(binascii.hexlify(data), 16) if data else 0
+
+
+def pack_move(symbol, cell, cells=9):
+    """Returns the packed encoding of symbol moving on cell, for a board
+    with the given number of cells"""
+    if cells <= SMALL_BOARD_CELLS:
+        return bytes(bytearray([cell | O_MOVE if symbol == 'O' else cell]))
+    value = cell | O_MOVE_WIDE if symbol == 'O' else cell
+    return bytes(bytearray([value >> 8, value & 0xff]))
+
+
+def unpack_moves(data, cells=9):
+    """Returns the (symbol, cell) pairs of a packed move history"""
+    data = bytearray(data)
+    if cells <= SMALL_BOARD_CELLS:
+        return [('O' if byte & O_MOVE else 'X', byte & CELL_BITS)
+                for byte in data]
+    values = [data[index] << 8 | data[index + 1]
+              for index in range(0, len(data), 2)]
+    return [('O' if value & O_MOVE_WIDE else 'X', value & CELL_BITS_WIDE)
+            for value in values]
@@ -0,0 +1,136 @@
+"""instrumentation.py - Per-request instrumentation of the endpoints and
+handlers.
+
+Every call of an instrumented function records its wall time, the API RPCs
+it made by service and method, the cache hits and misses of utils' cache and
+the size of its response. Calls slower than SLOW_REQUEST_MS are logged as a
+JSON record, and the last ROLLING_WINDOW calls of every endpoint are kept in
+memory for the admin stats page. All of it is per instance.
+
+The bookkeeping is a few dictionary updates per RPC and per call, so it is
+meant to stay enabled in production."""
+
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from protorpc import messages, protobuf
+
+# Calls slower than this many milliseconds are logged
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 1000))
+# Calls per endpoint kept for the rolling aggregates
+ROLLING_WINDOW = 500
+
+_local = threading.local()
+_lock = threading.Lock()
+_recent = collections.defaultdict(
+    lambda: collections.deque(maxlen=ROLLING_WINDOW))
+
+
+def _current():
+    """Returns the record of the call being instrumented on this thread"""
+    return getattr(_local, 'record', None)
+
+
+def _count_rpc(service, call, request, response):
+    record = _current()
+    if record is not None:
+        rpc = '{}.{}'.format(service, call)
+        record['rpcs'][rpc] = record['rpcs'].get(rpc, 0) + 1
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'instrumentation', _count_rpc)
+
+
+def count_cache(hit):
+    """Counts a cache hit or miss against the current call"""
+    record = _current()
+    if record is not None:
+        record['cache_hits' if hit else 'cache_misses'] += 1
+
+
+def _response_size(response):
+    if isinstance(response, messages.Message):
+        return len(protobuf.encode_message(response))
+    return None
+
+
+def instrumented(func=None, name=None):
+    """Decorator recording each call of func under name (default: the
+    function's name). Use it below @endpoints.method."""
+    if func is None:
+        return functools.partial(instrumented, name=name)
+    name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = _current()
+        record = _local.record = {
+            'endpoint': name, 'rpcs': {}, 'cache_hits': 0,
+            'cache_misses': 0, 'response_bytes': None, 'error': None}
+        start = time.time()
+        try:
+            response = func(*args, **kwargs)
+            record['response_bytes'] = _response_size(response)
+            return response
+        except Exception as e:
+            record['error'] = e.__class__.__name__
+            raise
+        finally:
+            _local.record = outer
+            record['ms'] = round((time.time() - start) * 1000, 2)
+            with _lock:
+                _recent[name].append(record)
+            if record['ms'] > SLOW_REQUEST_MS:
+                logging.warning('slow_request %s',
+                                json.dumps(record, sort_keys=True))
+    return wrapper
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def aggregates():
+    """Returns per endpoint aggregates of the recent calls on this
+    instance"""
+    with _lock:
+        recent = dict((name, list(records))
+                      for name, records in _recent.items())
+    stats = {}
+    for name, records in sorted(recent.items()):
+        if not records:
+            continue
+        latencies = sorted(record['ms'] for record in records)
+        rpcs = collections.Counter()
+        for record in records:
+            rpcs.update(record['rpcs'])
+        sizes = [record['response_bytes'] for record in records
+                 if record['response_bytes'] is not None]
+        calls = float(len(records))
+        stats[name] = {
+            'calls': len(records),
+            'errors': sum(1 for record in records if record['error']),
+            'slow': sum(1 for ms in latencies if ms > SLOW_REQUEST_MS),
+            'p50_ms': _percentile(latencies, 0.50),
+            'p95_ms': _percentile(latencies, 0.95),
+            'p99_ms': _percentile(latencies, 0.99),
+            'max_ms': latencies[-1],
+            'rpcs_per_call': dict((rpc, count / calls)
+                                  for rpc, count in rpcs.items()),
+            'cache_hit_rate': _hit_rate(records),
+            'mean_response_bytes': sum(sizes) / len(sizes) if sizes else None,
+        }
+    return stats
+
+
+def _hit_rate(records):
+    hits = sum(record['cache_hits'] for record in records)
+    lookups = hits + sum(record['cache_misses'] for record in records)
+    return hits / float(lookups) if lookups else None
@@ -0,0 +1,113 @@
+"""leaderboard.py - Ranked views of the users, by win percent and then by
+games played (User.rank_score).
+
+Users with the same rank_score share a rank: one more than the number of
+users with a higher score. Ranking pages are read in rank_score order with
+a projection, and their cursor carries the position, score and rank of the
+last user on the page, so no page costs more than the users on it. The
+first page of each size is cached for TOP_CACHE_SECONDS. A single user's
+rank is read from the counters of the leaderboard tree (see
+models.ScoreShard), a fixed number of gets by key however many users share
+their score range."""
+
+from google.appengine.api import memcache
+import endpoints
+
+from models import User, UserForm, ScoreShard, RANK_GAMES_LIMIT
+import utils
+
+TOP_CACHE_SECONDS = 60
+# Most users returned on each side of a user by users_around
+MAX_AROUND = 50
+
+
+def user_form(name, score, rank):
+    """Returns the UserForm of a user from its name and rank_score"""
+    return UserForm(name=name, rank=rank,
+                    win_percent=score // RANK_GAMES_LIMIT / 100.0,
+                    games_played=score % RANK_GAMES_LIMIT)
+
+
+def _parse_cursor(cursor):
+    """Splits a ranking cursor into the position, rank_score and rank of
+    the last user before it and the datastore cursor"""
+    if not cursor:
+        return 0, None, None, None
+    parts = cursor.split(':', 3)
+    if len(parts) != 4 or not all(part.isdigit() for part in parts[:3]) \
+            or not parts[3]:
+        raise endpoints.BadRequestException('Invalid cursor')
+    position, score, rank = [int(part) for part in parts[:3]]
+    return position, score, rank, parts[3]
+
+
+def ranking_page(page_size=None, cursor=None):
+    """Returns the UserForm list and next cursor of one ranking page. Users
+    with the same rank_score share the rank of the first of them, also
+    across pages."""
+    cache_key = 'leaderboard:top:{}'.format(page_size)
+    page = memcache.get(cache_key) if not cursor else None
+    if page is None:
+        position, last_score, last_rank, start = _parse_cursor(cursor)
+        users, next_cursor = utils.fetch_page(
+            User.query(User.rank_score >= 0).order(-User.rank_score),
+            page_size, start,
+            projection=[User.name, User.rank_score])
+        rows = []
+        for user in users:
+            position += 1
+            if user.rank_score != last_score:
+                last_score, last_rank = user.rank_score, position
+            rows.append((user.name, user.rank_score, last_rank))
+        if next_cursor:
+            next_cursor = '{}:{}:{}:{}'.format(position, last_score,
+                                               last_rank, next_cursor)
+        page = (rows, next_cursor)
+        if not cursor:
+            memcache.set(cache_key, page, time=TOP_CACHE_SECONDS)
+    users, next_cursor = page
+    return [user_form(*user) for user in users], next_cursor
+
+
+def rank(score):
+    """Returns the rank of a rank_score: one more than the number of users
+    with a higher score"""
+    return ScoreShard.count_above(score) + 1
+
+
+def users_around(user, count):
+    """Returns the UserForms of the user and up to count users ranked just
+    above and below them, ranked as rank() does. The ranks of the others
+    follow from the user's rank and the users read in between, except for
+    the farthest score above when not all of its users were read."""
+    count = max(0, min(count, MAX_AROUND))
+    my_rank = rank(user.rank_score)
+    projection = [User.name, User.rank_score]
+    # One user more than returned shows whether the farthest score above
+    # continues past the users read
+    above = User.query(User.rank_score > user.rank_score).order(
+        User.rank_score).fetch(count + 1, projection=projection)
+    below = [other for other in User.query(
+        User.rank_score <= user.rank_score, User.rank_score >= 0).order(
+            -User.rank_score).fetch(
+            count + 1, projection=projection) if other.key != user.key]
+
+    # A score above ranks after every user read up to its last one
+    ranks = dict((other.rank_score, my_rank - index - 1)
+                 for index, other in enumerate(above))
+    if count and len(above) > count and \
+            above[-1].rank_score == above[-2].rank_score:
+        ranks[above[-1].rank_score] = rank(above[-1].rank_score)
+    # A lower score ranks after the user and every user read before its
+    # first one
+    for index, other in reversed(list(enumerate(below))):
+        ranks[other.rank_score] = my_rank + index + 1
+    ranks[user.rank_score] = my_rank
+
+    forms = [user_form(other.name, other.rank_score, ranks[other.rank_score])
+             for other in reversed(above[:count])]
+    forms.append(user_form(user.name, user.rank_score, my_rank))
+    forms.extend(user_form(other.name, other.rank_score,
+                           ranks[other.rank_score])
+                 for other in below[:count])
+    return forms
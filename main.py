@@ -1,47 +1,373 @@
 #!/usr/bin/env python
 
 """main.py - This file contains handlers that are called by
-cronjobs."""
+cronjobs and the task queue."""
+import json
 import logging
+import time
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, memcache, taskqueue
 from api import TicTacToeApi
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
-from models import User, Game
+from models import User, Game, ScoreShard
+import instrumentation
+from instrumentation import instrumented
+import matchmaking
+import openings
+import utils
+
+
+# Active games read per reminder page task, and users handled per reminder
+# batch task. Can be overridden per run with the batch_size query parameter.
+REMINDER_BATCH_SIZE = 100
+# Seconds per reminder run: a user is sent at most one reminder per run
+REMINDER_INTERVAL = 60 * 60
+# Most tasks the task queue accepts in one add call
+MAX_TASKS_PER_ADD = 100
+
+
+def add_named(tasks):
+    """Adds the named tasks in add calls of up to MAX_TASKS_PER_ADD,
+    skipping those already added or run"""
+    queue = taskqueue.Queue()
+    for index in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[index:index + MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+def reminder_page_task(run, page, batch_size, cursor=None):
+    """The task reading one page of active games of a reminder run"""
+    params = {'run': run, 'page': page, 'batch_size': batch_size}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    return taskqueue.Task(url='/tasks/send_reminder_page', params=params,
+                          name='send-reminders-{}-{}'.format(run, page))
+
+
+def claim_reminders(run, page, user_keys):
+    """Claims the users for one page of a reminder run with one memcache
+    add_multi, and returns those the page claimed, sorted. A user claimed
+    by an earlier page of the run is left out; one claimed by an earlier
+    try of the same page is kept, so a retried page sends the same
+    batches. If memcache is unavailable every user is returned."""
+    claims = dict(('reminder:{}:{}'.format(run, key.urlsafe()), key)
+                  for key in user_keys)
+    taken = memcache.add_multi(dict((claim, page) for claim in claims),
+                               time=2 * REMINDER_INTERVAL)
+    if taken:
+        owners = memcache.get_multi(taken)
+        for claim in taken:
+            if owners.get(claim, page) != page:
+                del claims[claim]
+    return sorted(claims.values())
 
 
 class SendReminderEmail(webapp2.RequestHandler):
 
+    @instrumented(name='send_reminder')
     def get(self):
         """Send a reminder email to each User with an email about tictactoe.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        games = Game.query(
-            ndb.AND(Game.game_over == False, Game.is_cancelled == False))
+        Called every hour using a cron job. Starts the run by enqueuing the
+        SendReminderPage task of the first page of active games"""
+        run = int(time.time() // REMINDER_INTERVAL)
+        batch_size = int(self.request.get('batch_size') or
+                         REMINDER_BATCH_SIZE)
+        add_named([reminder_page_task(run, 0, batch_size)])
+
+
+class SendReminderPage(webapp2.RequestHandler):
+
+    @instrumented(name='send_reminder_page')
+    def post(self):
+        """Reads one page of active games, claims its players for the run
+        and enqueues SendReminderBatch tasks of batch_size of them, then the
+        task of the next page. A player in games on several pages is sent
+        one email per run. The batch tasks are named after the run, page and
+        batch, so a retried page adds nothing twice"""
+        start = time.time()
+        run = int(self.request.get('run'))
+        page = int(self.request.get('page'))
+        batch_size = int(self.request.get('batch_size'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+            ndb.AND(Game.game_over == False, Game.is_cancelled == False)
+        ).fetch_page(batch_size, start_cursor=cursor,
+                     projection=[Game.player_x, Game.player_o])
+        user_keys = set()
         for game in games:
-            subject = 'This is a gentle reminder!'
-            user1 = game.player_x.get()
-            if user1.email != None:
+            user_keys.update([game.player_x, game.player_o])
+        user_keys = claim_reminders(
+            run, page, [key for key in user_keys if key.id() != User.AI_ID])
+        add_named([taskqueue.Task(
+            url='/tasks/send_reminders',
+            params={'user_keys': ','.join(
+                key.urlsafe() for key in user_keys[index:index + batch_size])},
+            name='reminders-{}-{}-{}'.format(run, page, index // batch_size))
+            for index in range(0, len(user_keys), batch_size)])
+        if more and next_cursor:
+            add_named([reminder_page_task(run, page + 1, batch_size,
+                                          next_cursor)])
+        logging.info('Reminder run %d page %d: %d active games, %d users '
+                     'claimed in %.2fs', run, page, len(games),
+                     len(user_keys), time.time() - start)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+
+    @instrumented(name='send_reminder_batch')
+    def post(self):
+        """Sends the reminder email to one batch of users. Enqueued by
+        SendReminderPage"""
+        app_id = app_identity.get_application_id()
+        keys = [ndb.Key(urlsafe=urlsafe)
+                for urlsafe in self.request.get('user_keys').split(',')
+                if urlsafe]
+        subject = 'This is a gentle reminder!'
+        sent = 0
+        for user in ndb.get_multi(keys):
+            if user and user.email:
                 body = 'Hello {}, try out our exciting new TicTacToe Game!'.\
-                    format(user1.name)
+                    format(user.name)
                 # This will send test emails, the arguments to send_mail are:
                 # from, to, subject, body
                 mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user1.email,
-                               subject,
-                               body)
-            user2 = game.player_o.get()
-            if user2.email != None:
-                body = 'Hello {}, try out our exciting new TicTacToe Game!'.\
-                    format(user2.name)
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user2.email,
+                               user.email,
                                subject,
                                body)
+                sent += 1
+        logging.info('Sent %d reminders to %d users', sent, len(keys))
+
+
+BACKFILL_BATCH_SIZE = 50
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+
+    def get(self):
+        """One-off job seeding the User game counters from the finished
+        Games. Handles one page of users and enqueues itself for the next.
+        Start it once by visiting /tasks/backfill_user_stats as an admin"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        for user in users:
+            finished = ndb.AND(Game.game_over == True,
+                               Game.participants == user.key)
+            user.games_played = Game.query(finished).count()
+            user.wins = Game.query(ndb.AND(
+                Game.game_over == True, Game.winner == user.name)).count()
+            user.ties = Game.query(ndb.AND(
+                finished, Game.winner == '')).count()
+            user.losses = user.games_played - user.wins - user.ties
+        ndb.put_multi(users)
+        logging.info('Backfilled stats for %d users', len(users))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_stats', method='GET',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+@ndb.transactional_tasklet
+def _reindex_game_async(key):
+    """Rewrites a game so its computed properties are indexed"""
+    game = yield key.get_async()
+    if game:
+        yield game.put_async()
+
+
+class BackfillGameIndex(webapp2.RequestHandler):
+
+    def get(self):
+        """One-off job writing the participants and status of the Games
+        stored before they were added. Rewrites one page of games, each in
+        its own transaction so no concurrent move is lost, and enqueues
+        itself for the next. Start it once by visiting
+        /tasks/backfill_game_index as an admin"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        ndb.Future.wait_all([_reindex_game_async(key) for key in keys])
+        logging.info('Reindexed %d games', len(keys))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_game_index', method='GET',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+# Users read per page when the leaderboard counters are rebuilt
+REBUILD_BATCH_SIZE = 500
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+
+    def get(self):
+        """Rebuilds the leaderboard counters from the users. First deletes
+        the existing ScoreShards a page at a time, then adds up one page of
+        users after another into shard 0 of each node, enqueueing itself
+        for each next page. Run it by visiting /tasks/rebuild_leaderboard
+        as an admin after backfilling the user stats, or whenever the
+        counts need repairing, while few games are ending"""
+        if not self.request.get('counting'):
+            keys = ScoreShard.query().fetch(REBUILD_BATCH_SIZE,
+                                            keys_only=True)
+            ndb.delete_multi(keys)
+            params = {} if keys else {'counting': 1}
+            taskqueue.add(url='/tasks/rebuild_leaderboard', method='GET',
+                          params=params)
+            return
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            REBUILD_BATCH_SIZE, start_cursor=cursor,
+            projection=[User.rank_score])
+        deltas = ScoreShard.deltas(
+            [(None, user.rank_score) for user in users
+             if user.key.id() != User.AI_ID])
+        keys = [ScoreShard.key_for(level, node, 0)
+                for level, node in deltas]
+        shards = [shard or ScoreShard(key=key, level=level, node=node,
+                                      counts={})
+                  for key, (level, node), shard in zip(
+                      keys, list(deltas), ndb.get_multi(keys))]
+        for shard in shards:
+            shard.add(deltas[(shard.level, shard.node)])
+        ndb.put_multi(shards)
+        logging.info('Counted %d users on the leaderboard', len(users))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rebuild_leaderboard', method='GET',
+                          params={'counting': 1,
+                                  'cursor': next_cursor.urlsafe()})
+
+
+class PairPlayers(webapp2.RequestHandler):
+
+    def post(self):
+        """Pairs the users waiting in the matchmaking queue. Enqueued when a
+        user joins, and continues itself with the next batch while there is
+        one"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        _, _, next_cursor = matchmaking.pair_waiting(cursor)
+        if next_cursor:
+            taskqueue.add(url='/tasks/pair_players',
+                          params={'cursor': next_cursor.urlsafe()})
+
+    def get(self):
+        """Called every minute by a cron job, to drop expired tickets and
+        pair users left waiting"""
+        matchmaking.expire_stale()
+        matchmaking.enqueue_pairing()
+
+
+class RecordPositions(webapp2.RequestHandler):
+
+    def post(self):
+        """Counts the finished games queued for the opening book, in
+        batches, and enqueues itself again if some may be left"""
+        counted, more = openings.drain()
+        logging.info('Counted %d games in the opening book', counted)
+        if more:
+            openings.enqueue_drain()
+
+    def get(self):
+        """Called every minute by a cron job, to start counting the games
+        that ended since"""
+        openings.enqueue_drain(
+            name='record-positions-{}'.format(int(time.time() // 60)))
+
+
+class BackfillPositionStats(webapp2.RequestHandler):
+
+    def post(self):
+        """Counts one page of the finished games in the opening book and
+        enqueues itself for the next. Games already counted are skipped, so
+        it can be rerun safely. Start it once from the task queue console
+        on the position-stats queue, or by visiting
+        /tasks/backfill_position_stats as an admin"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+            Game.game_over == True).order(Game.key).fetch_page(
+                BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        counted = openings.record_games(games)
+        logging.info('Counted %d of %d games in the opening book',
+                     counted, len(games))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_position_stats',
+                          queue_name=openings.QUEUE,
+                          params={'cursor': next_cursor.urlsafe()})
+
+    def get(self):
+        """Starts the backfill on the position-stats queue"""
+        taskqueue.add(url='/tasks/backfill_position_stats',
+                      queue_name=openings.QUEUE)
+
+
+# Finished games read per datastore batch by the export, and the most games
+# one export request returns. Responses are buffered by App Engine, so the
+# limit is what bounds an export request's memory.
+EXPORT_BATCH_SIZE = 100
+EXPORT_MAX_GAMES = 2000
+
+
+class ExportGames(webapp2.RequestHandler):
+
+    @instrumented(name='export_games')
+    def get(self):
+        """Exports finished games as newline delimited JSON, one
+        Game.to_record per line, in key order. Reads EXPORT_BATCH_SIZE games
+        and their players at a time and stops after limit games (at most
+        EXPORT_MAX_GAMES). The X-Export-Cursor header holds the cursor to
+        pass back as cursor for the next games; it is missing once every
+        game has been exported. A saved cursor resumes an export where it
+        stopped."""
+        limit = min(int(self.request.get('limit') or EXPORT_MAX_GAMES),
+                    EXPORT_MAX_GAMES)
+        cursor = self.request.get('cursor') or None
+        query = Game.query(Game.game_over == True).order(Game.key)
+        self.response.content_type = 'application/x-ndjson'
+        exported = 0
+        while exported < limit:
+            games, cursor = utils.fetch_page(
+                query, min(EXPORT_BATCH_SIZE, limit - exported), cursor)
+            player_keys = list(set(key for game in games
+                                   for key in (game.player_x, game.player_o)))
+            names = dict((user.key, user.name)
+                         for user in ndb.get_multi(player_keys) if user)
+            for game in games:
+                self.response.write(json.dumps(game.to_record(names),
+                                               sort_keys=True) + '\n')
+            exported += len(games)
+            if not cursor:
+                break
+        if cursor:
+            self.response.headers['X-Export-Cursor'] = cursor
+        logging.info('Exported %d games', exported)
+
+
+class RequestStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Returns the rolling per endpoint aggregates of this instance as
+        JSON"""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(instrumentation.aggregates(),
+                                       indent=2, sort_keys=True))
 
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/pair_players', PairPlayers),
+    ('/tasks/pair_players', PairPlayers),
+    ('/tasks/send_reminder_page', SendReminderPage),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/backfill_game_index', BackfillGameIndex),
+    ('/admin/request_stats', RequestStats),
+    ('/admin/export_games', ExportGames),
+    ('/crons/record_positions', RecordPositions),
+    ('/tasks/record_positions', RecordPositions),
+    ('/tasks/backfill_position_stats', BackfillPositionStats),
 ], debug=True)
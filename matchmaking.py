@@ -0,0 +1,153 @@
+"""matchmaking.py - Pairs the users waiting for a game.
+
+A user joins the queue by writing their MatchTicket, keyed by their name,
+and checks on it by getting that one entity: it says whether they are still
+waiting or which game they were put in. Joining enqueues a pairing task
+named after the current PAIR_INTERVAL window, so all the users joining
+within a few seconds of each other are paired by one task, and a cron job
+pairs whoever is left over. A pairing task reads a batch of the waiting
+tickets oldest first and pairs them within the same board shape and skill
+band, then goes on to the next batch, so tickets that cannot be paired never
+hide newer ones. Tickets waiting longer than TICKET_TTL are no longer paired
+and are dropped by the cron job. The game ids are allocated in one batch,
+then each game is created with its two tickets updated in one transaction,
+so a user who leaves the queue meanwhile is never put in a game."""
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Game, MatchTicket
+
+# Seconds of joins paired together by one task
+PAIR_INTERVAL = 5
+# Most waiting tickets a pairing task reads
+PAIR_BATCH_SIZE = 500
+# Win percent points per skill band
+SKILL_BAND_WIDTH = 20
+# Seconds a ticket waits to be paired before it is dropped
+TICKET_TTL = 10 * 60
+
+
+def skill_band(user):
+    """Returns the skill band of a user's win percent, from 0 to 4"""
+    return int(min(user.win_percent, 99.99) // SKILL_BAND_WIDTH)
+
+
+def join(user, size=3, win_length=3, banded=False):
+    """Puts the user in the queue, replacing any earlier ticket of theirs,
+    and returns the ticket. With banded, the user is only paired with users
+    of the same skill band."""
+    ticket = MatchTicket(key=MatchTicket.key_for(user.name), user=user.key,
+                         size=size, win_length=win_length,
+                         band=skill_band(user) if banded
+                         else MatchTicket.ANY_BAND)
+    ticket.put()
+    enqueue_pairing(countdown=PAIR_INTERVAL)
+    return ticket
+
+
+@ndb.transactional
+def leave(name):
+    """Takes a waiting user out of the queue. Returns False if they were
+    not waiting."""
+    ticket = MatchTicket.key_for(name).get()
+    if not ticket or not ticket.waiting:
+        return False
+    ticket.key.delete()
+    return True
+
+
+def enqueue_pairing(countdown=0):
+    """Enqueues the pairing task of the current window, once per window"""
+    window = int(time.time() // PAIR_INTERVAL)
+    try:
+        taskqueue.add(url='/tasks/pair_players',
+                      name='pair-players-{}'.format(window),
+                      countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def _ttl_cutoff():
+    """Returns the creation time before which a ticket has expired"""
+    return datetime.utcnow() - timedelta(seconds=TICKET_TTL)
+
+
+def pair_waiting(cursor=None):
+    """Pairs up to PAIR_BATCH_SIZE waiting tickets that have not expired,
+    oldest first from the cursor. Returns (games created, tickets read,
+    cursor of the next batch or None)."""
+    tickets, next_cursor, more = MatchTicket.query(
+        MatchTicket.waiting == True,
+        MatchTicket.created >= _ttl_cutoff()).order(
+        MatchTicket.created).fetch_page(PAIR_BATCH_SIZE, start_cursor=cursor)
+    next_cursor = next_cursor if more else None
+    unpaired = {}
+    pairs = []
+    for ticket in tickets:
+        shape = (ticket.size, ticket.win_length, ticket.band)
+        if shape in unpaired:
+            pairs.append((unpaired.pop(shape), ticket))
+        else:
+            unpaired[shape] = ticket
+    if not pairs:
+        return 0, len(tickets), next_cursor
+    first_id, _ = Game.allocate_ids(len(pairs))
+    futures = [_pair_async(ndb.Key(Game, first_id + index), first.key,
+                           second.key)
+               for index, (first, second) in enumerate(pairs)]
+    ndb.Future.wait_all(futures)
+    created = sum(1 for future in futures if future.get_result())
+    logging.info('Paired %d of %d waiting users', 2 * created, len(tickets))
+    return created, len(tickets), next_cursor
+
+
+def expire_stale():
+    """Drops up to PAIR_BATCH_SIZE tickets that waited longer than
+    TICKET_TTL. Returns how many were dropped."""
+    cutoff = _ttl_cutoff()
+    keys = MatchTicket.query(MatchTicket.waiting == True,
+                             MatchTicket.created < cutoff).fetch(
+        PAIR_BATCH_SIZE, keys_only=True)
+    futures = [_expire_async(key, cutoff) for key in keys]
+    ndb.Future.wait_all(futures)
+    expired = sum(1 for future in futures if future.get_result())
+    if expired:
+        logging.info('Dropped %d expired matchmaking tickets', expired)
+    return expired
+
+
+@ndb.transactional_tasklet
+def _expire_async(key, cutoff):
+    """Deletes the ticket if it is still waiting and was created before
+    cutoff, so a ticket just paired or written again is kept. Returns
+    whether it did."""
+    ticket = yield key.get_async()
+    if not ticket or not ticket.waiting or ticket.created >= cutoff:
+        raise ndb.Return(False)
+    yield key.delete_async()
+    raise ndb.Return(True)
+
+
+@ndb.transactional_tasklet(xg=True)
+def _pair_async(game_key, first_key, second_key):
+    """Creates the game of two tickets, the older one playing X, if both
+    are still waiting for the same game. Returns whether it did."""
+    first, second = yield ndb.get_multi_async([first_key, second_key])
+    if not (first and first.waiting and second and second.waiting) or \
+            (first.size, first.win_length, first.band) != \
+            (second.size, second.win_length, second.band):
+        raise ndb.Return(False)
+    game = Game(key=game_key, player_x=first.user, player_o=second.user,
+                next_turn=first.key.id(), size=first.size,
+                win_length=first.win_length, created=datetime.utcnow())
+    for ticket in first, second:
+        ticket.waiting = False
+        ticket.game = game_key
+    yield ndb.put_multi_async([game, first, second])
+    raise ndb.Return(True)
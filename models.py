@@ -3,86 +3,475 @@ entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
 import random
-from datetime import date
+from datetime import date, datetime
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import engine
+import utils
+
+
+# Users are ranked by win percent, then by games played. rank_score packs
+# both into one integer: the win percent in hundredths of a percent times
+# RANK_GAMES_LIMIT plus the games played (capped below RANK_GAMES_LIMIT).
+RANK_GAMES_LIMIT = 10 ** 7
+# The leaderboard counts users in a tree over rank_score: each level splits
+# its buckets into RANK_FANOUT, and the last level is single scores. The
+# first level buckets are one win percent point wide.
+RANK_FANOUT = 1000
+RANK_LEVELS = 4
+
+
+def rank_score(win_percent, games_played):
+    """Returns the leaderboard score of a win percent and games played"""
+    return int(round(win_percent * 100)) * RANK_GAMES_LIMIT + \
+        min(games_played, RANK_GAMES_LIMIT - 1)
+
+
+def score_path(score):
+    """Returns the (level, node, child) positions of a rank_score in the
+    leaderboard tree, from the root down: node is the bucket the score is
+    in at that level and child the bucket of the next level below it."""
+    path = []
+    for level in range(RANK_LEVELS):
+        width = RANK_FANOUT ** (RANK_LEVELS - 1 - level)
+        path.append((level, score // (width * RANK_FANOUT),
+                     score // width % RANK_FANOUT))
+    return path
+
+
+class MaskProperty(ndb.BlobProperty):
+
+    """A board bitmask of any width, stored as big-endian bytes. Storing
+    them as a blob keeps the datastore from handing the bytes back as
+    unicode. Masks written before this were stored as integers and are
+    still read as such."""
+
+    def _validate(self, value):
+        if not isinstance(value, (int, long)) or value < 0:
+            raise TypeError('Expected a non-negative integer mask, got %r'
+                            % (value,))
+
+    def _to_base_type(self, value):
+        return engine.mask_to_bytes(value)
+
+    def _from_base_type(self, value):
+        if isinstance(value, (int, long)):
+            return value
+        return engine.mask_from_bytes(value)
+
+    def _db_get_value(self, v, p):
+        if v.has_int64value():
+            return v.int64value()
+        return super(MaskProperty, self)._db_get_value(v, p)
+
 
 class User(ndb.Model):
 
     """User profile"""
+    # The user the computer plays as in single player games
+    AI_ID = 'computer'
+    AI_NAME = 'Computer'
+
     name = ndb.StringProperty(required=True)
     #  Email is an optional field for User
     email = ndb.StringProperty()
-    win_percent = ndb.FloatProperty(required=True, default=0.0)
-
-    def to_form(self):
+    games_played = ndb.IntegerProperty(required=True, default=0)
+    wins = ndb.IntegerProperty(required=True, default=0)
+    losses = ndb.IntegerProperty(required=True, default=0)
+    ties = ndb.IntegerProperty(required=True, default=0)
+    win_percent = ndb.ComputedProperty(
+        lambda self: self.wins / float(self.games_played) * 100
+        if self.games_played else 0.0)
+    # -1 for the computer, which is left off the leaderboard
+    rank_score = ndb.ComputedProperty(
+        lambda self: -1 if self.is_ai else
+        rank_score(self.win_percent, self.games_played))
+
+    @property
+    def is_ai(self):
+        """True for the user the computer plays as"""
+        return self.key is not None and self.key.id() == self.AI_ID
+
+    def to_form(self, rank=None):
         '''Returns a UserForm representation of User'''
         form = UserForm()
         form.name = self.name
         form.win_percent = self.win_percent
+        form.games_played = self.games_played
+        form.rank = rank
         return form
 
+    def _post_put_hook(self, future):
+        utils.invalidate(self.key)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def create(cls, name, email=None, id=None):
+        """Creates and stores a User and counts it on the leaderboard. If
+        id is given and that user exists, returns it instead."""
+        if id:
+            user = cls.get_by_id(id)
+            if user:
+                return user
+        user = cls(id=id, name=name, email=email)
+        shards = [] if user.is_ai else ScoreShard.update_async(
+            [(None, user.rank_score)]).get_result()
+        ndb.put_multi([user] + shards)
+        return user
+
+    @classmethod
+    def get_ai_user(cls):
+        """Returns the user the computer plays as, creating it if needed"""
+        return cls.get_by_id(cls.AI_ID) or \
+            cls.create(cls.AI_NAME, id=cls.AI_ID)
+
+    def record_result(self, won=False, tied=False):
+        """Counts a finished game - won or tied, otherwise a loss"""
+        self.games_played += 1
+        if won:
+            self.wins += 1
+        elif tied:
+            self.ties += 1
+        else:
+            self.losses += 1
+
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
 
 
+class ScoreShard(ndb.Model):
+
+    """One shard of a node of the leaderboard tree (see score_path): the
+    number of users in each child bucket of the node. A user's rank adds up
+    the children above theirs at every level, so it costs RANK_LEVELS *
+    SHARDS gets by key however many users there are. Each node is split
+    over SHARDS entities so that games ending at the same time rarely write
+    the same one."""
+    SHARDS = 20
+
+    level = ndb.IntegerProperty(required=True, indexed=False)
+    node = ndb.IntegerProperty(required=True, indexed=False)
+    # Users per child bucket, keyed by the child as a string
+    counts = ndb.JsonProperty()
+
+    @classmethod
+    def key_for(cls, level, node, shard):
+        """Returns the key of one shard of a node"""
+        return ndb.Key(cls, '{}-{}-{}'.format(level, node, shard))
+
+    @staticmethod
+    def deltas(changes):
+        """Returns {(level, node): {child: delta}} for (old, new) rank_score
+        pairs, without the zero deltas; old is None for a new user."""
+        deltas = {}
+        for old, new in changes:
+            for score, delta in ((old, -1), (new, 1)):
+                if score is None:
+                    continue
+                for level, node, child in score_path(score):
+                    children = deltas.setdefault((level, node), {})
+                    children[child] = children.get(child, 0) + delta
+        for children in deltas.values():
+            for child in [child for child in children if not children[child]]:
+                del children[child]
+        return dict((node, children) for node, children in deltas.items()
+                    if children)
+
+    @classmethod
+    @ndb.tasklet
+    def update_async(cls, changes):
+        """Moves users between buckets. changes holds an (old, new)
+        rank_score pair per user; old is None for a new user. Returns the
+        changed shards, which the caller puts in its transaction. Only the
+        nodes under which old and new differ change."""
+        deltas = cls.deltas(changes)
+        nodes = list(deltas)
+        keys = [cls.key_for(level, node, random.randrange(cls.SHARDS))
+                for level, node in nodes]
+        shards = yield ndb.get_multi_async(keys)
+        shards = [shard or cls(key=key, level=level, node=node, counts={})
+                  for key, (level, node), shard in zip(keys, nodes, shards)]
+        for shard in shards:
+            shard.add(deltas[(shard.level, shard.node)])
+        raise ndb.Return(shards)
+
+    def add(self, children):
+        """Adds {child: delta} to the counts"""
+        counts = dict(self.counts or {})
+        for child, delta in children.items():
+            counts[str(child)] = counts.get(str(child), 0) + delta
+        self.counts = counts
+
+    @classmethod
+    def count_above(cls, score):
+        """Returns the number of users with a higher rank_score"""
+        path = score_path(score)
+        keys = [cls.key_for(level, node, shard) for level, node, _ in path
+                for shard in range(cls.SHARDS)]
+        above = 0
+        for index, shard in enumerate(ndb.get_multi(keys)):
+            if shard:
+                child = path[index // cls.SHARDS][2]
+                above += sum(count for key, count in shard.counts.items()
+                             if int(key) > child)
+        return above
+
+
+class PositionStats(ndb.Model):
+
+    """How often a 3 x 3 position occurred in finished games and how each
+    reply to it turned out. Keyed by the position's canonical code (see
+    ai.canonical), so symmetric positions share one entity. replies maps
+    the canonical code of the position after a reply to [wins, losses,
+    draws] for the side that made it."""
+    occurrences = ndb.IntegerProperty(required=True, default=0,
+                                      indexed=False)
+    replies = ndb.JsonProperty()
+
+    @classmethod
+    def key_for(cls, code):
+        """Returns the key of the stats of a canonical position code"""
+        return ndb.Key(cls, str(code))
+
+
 class Game(ndb.Model):
 
     """Game object"""
     winner = ndb.StringProperty(required=True, default="")
     next_turn = ndb.StringProperty(required=True, default="")
     game_over = ndb.BooleanProperty(required=True, default=False)
-    board = ndb.JsonProperty(
-        required=True, default=['-', '-', '-', '-', '-', '-', '-', '-', '-'])
+    # The board is size x size and won by win_length in a row
+    size = ndb.IntegerProperty(required=True, default=3)
+    win_length = ndb.IntegerProperty(required=True, default=3)
+    # The board as one bitmask per side, see engine.py
+    x_mask = MaskProperty(required=True, default=0)
+    o_mask = MaskProperty(required=True, default=0)
     player_x = ndb.KeyProperty(required=True, kind='User')
     player_o = ndb.KeyProperty(required=True, kind='User')
     number_of_moves = ndb.IntegerProperty(required=True, default=0)
-    history = ndb.JsonProperty(required=True, default=[])
+    # The moves packed one or two bytes each, see engine.pack_move
+    moves = ndb.BlobProperty(default='')
     is_cancelled = ndb.BooleanProperty(required=True, default=False)
+    # 'X' or 'O' when the computer plays that side
+    ai_side = ndb.StringProperty()
+    # JSON board and history of games written before the packed encoding.
+    # They are converted the first time such a game is used.
+    legacy_board = ndb.JsonProperty('board', indexed=False)
+    legacy_history = ndb.JsonProperty('history', indexed=False)
+    # Set where games are made, and never on a later put, so games written
+    # before they were recorded keep neither
+    created = ndb.DateTimeProperty(indexed=False)
+    ended = ndb.DateTimeProperty(indexed=False)
+    # Set once the game's positions are counted in PositionStats
+    in_position_stats = ndb.BooleanProperty(default=False, indexed=False)
+    # Both players and the state of the game, so a user's games in one
+    # state are found with equality filters alone. Kept up to date on
+    # every put.
+    participants = ndb.ComputedProperty(
+        lambda self: [self.player_x, self.player_o], repeated=True)
+    status = ndb.ComputedProperty(
+        lambda self: Game.CANCELLED if self.is_cancelled else
+        Game.COMPLETED if self.game_over else Game.ACTIVE)
+
+    ACTIVE = 'active'
+    COMPLETED = 'completed'
+    CANCELLED = 'cancelled'
 
     @classmethod
-    def new_game(cls, player_x, player_o, next_turn):
+    def new_game(cls, player_x, player_o, next_turn, ai_side=None, size=3,
+                 win_length=3):
         """Creates and returns a new game"""
         game = Game(player_x=player_x,
                     player_o=player_o,
                     next_turn=next_turn,
-                    game_over=False)
+                    game_over=False,
+                    ai_side=ai_side,
+                    size=size,
+                    win_length=win_length,
+                    created=datetime.utcnow())
         game.put()
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def _pre_put_hook(self):
+        self._migrate()
+
+    def _post_put_hook(self, future):
+        utils.invalidate(self.key)
+
+    @classmethod
+    def query_user(cls, user_key, status):
+        """Returns the query of a user's games in the given status, in key
+        order"""
+        return cls.query(cls.participants == user_key,
+                         cls.status == status).order(cls.key)
+
+    @property
+    def cells(self):
+        """The number of cells on the board"""
+        return self.size * self.size
+
+    def _migrate(self):
+        """Converts a game stored with the JSON board and history. Those
+        games were all 3 x 3."""
+        if self.legacy_board is not None:
+            self.x_mask = engine.mask_from_board(self.legacy_board, 'X')
+            self.o_mask = engine.mask_from_board(self.legacy_board, 'O')
+            self.legacy_board = None
+        if self.legacy_history is not None:
+            self.moves = ''.join(
+                engine.pack_move(entry['Player'], entry['Move'] - 1)
+                for entry in self.legacy_history)
+            self.legacy_history = None
+
+    @property
+    def board(self):
+        """The board as a list of 'X', 'O' or '-' per cell"""
+        self._migrate()
+        return engine.board_from_masks(self.x_mask, self.o_mask, self.size)
+
+    @property
+    def history(self):
+        """The moves as a list of dicts with the Player, Move and Result.
+        Only the last move of a finished game can have ended it."""
+        self._migrate()
+        history = [{'Player': symbol, 'Move': cell + 1, 'Result': 'Move made'}
+                   for symbol, cell in engine.unpack_moves(self.moves,
+                                                           self.cells)]
+        if history and self.game_over:
+            history[-1]['Result'] = ('Win! Game Over.' if self.winner
+                                     else 'Game over. It was a tie!')
+        return history
+
+    def to_form(self, message, names=None):
+        """Returns a GameForm representation of the Game. names maps player
+        keys to names when the players have already been fetched."""
+        if names is not None:
+            return self._to_form(message, names)
+        return Game.to_forms([self], message).items[0]
+
+    @classmethod
+    def to_forms(cls, games, message):
+        """Returns a GameForms representation of the games. The players of
+        all the games are fetched together in one batch get."""
+        player_keys = list(set(
+            key for game in games for key in (game.player_x, game.player_o)))
+        names = dict((user.key, user.name)
+                     for user in utils.get_entities(player_keys) if user)
+        return GameForms(items=[game._to_form(message, names)
+                                for game in games])
+
+    def _to_form(self, message, names):
+        """Returns a GameForm using the already fetched player names"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.player_x = self.player_x.get().name
-        form.player_o = self.player_o.get().name
+        form.player_x = names.get(self.player_x)
+        form.player_o = names.get(self.player_o)
         form.game_over = self.game_over
         form.next_turn = self.next_turn
         form.board = ','.join(self.board)
+        form.board_size = self.size
+        form.win_length = self.win_length
         form.winner = self.winner
         form.message = message
         return form
 
-    def end_game(self, winner_key, loser_key, won=False):
-        """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+    def to_history_form(self):
+        """Returns a GameHistoryForm of the moves made so far"""
+        return GameHistoryForm(
+            moves=[MoveHistoryForm(player=entry['Player'],
+                                   move=entry['Move'],
+                                   result=entry['Result'])
+                   for entry in self.history],
+            game_over=self.game_over)
+
+    def to_record(self, names):
+        """Returns the game as a JSON serializable dict for exports, using
+        the already fetched player names. moves is a list of [symbol, move]
+        pairs in the order they were made."""
+        self._migrate()
+        return {
+            'key': self.key.urlsafe(),
+            'player_x': names.get(self.player_x),
+            'player_o': names.get(self.player_o),
+            'ai_side': self.ai_side,
+            'board_size': self.size,
+            'win_length': self.win_length,
+            'winner': self.winner or None,
+            'tied': self.game_over and not self.winner,
+            'moves': [[symbol, cell + 1] for symbol, cell in
+                      engine.unpack_moves(self.moves, self.cells)],
+            'created': self.created and self.created.isoformat(),
+            'ended': self.ended and self.ended.isoformat(),
+        }
+
+    def mask(self, symbol):
+        """Returns the bitmask of the cells holding the given symbol"""
+        self._migrate()
+        return self.x_mask if symbol == 'X' else self.o_mask
+
+    def player(self, symbol):
+        """Returns the key of the player playing symbol"""
+        return self.player_x if symbol == 'X' else self.player_o
+
+    def opponent(self, player_key):
+        """Returns the key of the other player of the game"""
+        return self.player_o if player_key == self.player_x else self.player_x
+
+    def add_move(self, symbol, cell):
+        """Places symbol on cell and appends the move to the history.
+        Returns the mover's new bitmask"""
+        self._migrate()
+        self.moves += engine.pack_move(symbol, cell, self.cells)
+        if symbol == 'X':
+            self.x_mask = engine.place(self.x_mask, cell)
+            return self.x_mask
+        self.o_mask = engine.place(self.o_mask, cell)
+        return self.o_mask
+
+    def end_game(self, winner, loser, won=False):
+        """Ends the game - if won is True, the winner User won. - if won is
+        False, the game was a tie. Counts the result on both players; the
+        caller writes the game and the players in one transaction, so a
+        game is only ever counted once. The computer's results are not
+        counted, so single player games never write its User."""
         self.game_over = True
-        self.put()
-        users = []
-        users.append(winner_key.get())
-        users.append(loser_key.get())
-        for user in users:
-            games_played = Game.query(ndb.AND(Game.game_over == True, ndb.OR(\
-                Game.player_x == user.key, Game.player_o == \
-                user.key))).count()
-            games_won = Game.query(\
-                ndb.AND(Game.game_over == True, Game.winner == \
-                user.name)).count()
-            if games_played > 0:
-                user.win_percent = (games_won/float(games_played) * 100)
-                print(type(user.win_percent))
-                user.put()
+        self.ended = datetime.utcnow()
+        if not winner.is_ai:
+            winner.record_result(won=won, tied=not won)
+        if not loser.is_ai:
+            loser.record_result(tied=not won)
+
+
+class MatchTicket(ndb.Model):
+
+    """A user's place in the matchmaking queue, keyed by the user's name so
+    the user can check on it with one get. Once the user is paired,
+    waiting is False and game is the new game."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    waiting = ndb.BooleanProperty(required=True, default=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    size = ndb.IntegerProperty(required=True, default=3, indexed=False)
+    win_length = ndb.IntegerProperty(required=True, default=3,
+                                     indexed=False)
+    # Win percent band the opponent must share, or ANY_BAND
+    band = ndb.IntegerProperty(required=True, default=-1, indexed=False)
+    game = ndb.KeyProperty(kind='Game', indexed=False)
+
+    ANY_BAND = -1
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of a user's ticket"""
+        return ndb.Key(cls, name)
+
+    def to_form(self):
+        """Returns a MatchTicketForm representation of the ticket"""
+        return MatchTicketForm(
+            user_name=self.key.id(), waiting=self.waiting,
+            urlsafe_game_key=self.game and self.game.urlsafe(),
+            board_size=self.size, win_length=self.win_length,
+            skill_band=None if self.band == self.ANY_BAND else self.band)
 
 
 class GameForm(messages.Message):
@@ -97,6 +486,8 @@ class GameForm(messages.Message):
     player_o = messages.StringField(6)
     urlsafe_key = messages.StringField(7)
     message = messages.StringField(8, required=True)
+    board_size = messages.IntegerField(9)
+    win_length = messages.IntegerField(10)
 
 
 class UserForm(messages.Message):
@@ -104,31 +495,50 @@ class UserForm(messages.Message):
     '''UserForm for sending user ranking information'''
     name = messages.StringField(1, required=True)
     win_percent = messages.FloatField(2, required=True)
+    rank = messages.IntegerField(3)
+    games_played = messages.IntegerField(4)
 
 
 class UserForms(messages.Message):
 
     '''UserForms for returning multiple UserForms'''
     users = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class GameForms(messages.Message):
 
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class MoveHistoryForm(messages.Message):
+
+    '''One move of a game: the symbol that made it, the move number and its
+    result'''
+    player = messages.StringField(1, required=True)
+    move = messages.IntegerField(2, required=True)
+    result = messages.StringField(3, required=True)
 
 
 class GameHistoryForm(messages.Message):
 
-    '''Used to send the Game History information'''
-    game_history = messages.StringField(1, required=True)
+    '''Used to send the Game History information, one entry per move'''
+    moves = messages.MessageField(MoveHistoryForm, 2, repeated=True)
+    game_over = messages.BooleanField(3)
 
 
 class NewGameForm(messages.Message):
 
-    """Used to create a new game"""
-    player_x = messages.StringField(1, required=True)
-    player_o = messages.StringField(2, required=True)
+    """Used to create a new game. The player the computer takes the place
+    of (ai_side 'X' or 'O') is left out. The board is board_size x
+    board_size and won by win_length in a row, 3 and 3 by default."""
+    player_x = messages.StringField(1)
+    player_o = messages.StringField(2)
+    ai_side = messages.StringField(3)
+    board_size = messages.IntegerField(4, default=3)
+    win_length = messages.IntegerField(5, default=3)
 
 
 class MakeMoveForm(messages.Message):
@@ -138,6 +548,60 @@ class MakeMoveForm(messages.Message):
     player_name = messages.StringField(2, required=True)
 
 
+class MakeMovesForm(messages.Message):
+
+    """Used to make several moves in an existing game at once"""
+    moves = messages.MessageField(MakeMoveForm, 1, repeated=True)
+
+
+class ReplayGameForm(messages.Message):
+
+    """Used to create a game and play a list of moves in it"""
+    player_x = messages.StringField(1, required=True)
+    player_o = messages.StringField(2, required=True)
+    moves = messages.MessageField(MakeMoveForm, 3, repeated=True)
+    board_size = messages.IntegerField(4, default=3)
+    win_length = messages.IntegerField(5, default=3)
+
+
+class MakeMovesResultForm(messages.Message):
+
+    """Game state after several moves, with the position (from 1) of the
+    move that ended the game, if one did"""
+    game = messages.MessageField(GameForm, 1, required=True)
+    ending_move = messages.IntegerField(2)
+
+
+class MoveStatsForm(messages.Message):
+
+    """How one reply to a position turned out for the side making it"""
+    move = messages.IntegerField(1, required=True)
+    played = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    losses = messages.IntegerField(4, required=True)
+    draws = messages.IntegerField(5, required=True)
+
+
+class PositionStatsForm(messages.Message):
+
+    """How often a game's position occurred and the stats of each free
+    move, most played first"""
+    occurrences = messages.IntegerField(1, required=True)
+    moves = messages.MessageField(MoveStatsForm, 2, repeated=True)
+
+
+class MatchTicketForm(messages.Message):
+
+    """A user's matchmaking status. urlsafe_game_key is set once the user
+    has been paired"""
+    user_name = messages.StringField(1, required=True)
+    waiting = messages.BooleanField(2, required=True)
+    urlsafe_game_key = messages.StringField(3)
+    board_size = messages.IntegerField(4)
+    win_length = messages.IntegerField(5)
+    skill_band = messages.IntegerField(6)
+
+
 class StringMessage(messages.Message):
 
     """StringMessage-- outbound (single) string message"""
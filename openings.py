@@ -0,0 +1,152 @@
+"""openings.py - Opening book of the classic 3 x 3 game, built from the
+finished games.
+
+Every position a move was made from is reduced by the board's symmetries
+(ai.canonical) and counted in one PositionStats entity, together with the
+outcome of the reply made from it. The transaction that ends a game puts
+its key on the position-games pull queue. A record_positions task, started
+every minute, leases those keys RECORD_BATCH_SIZE at a time and counts each
+batch with one read and one write of the positions it touches, so the
+opening positions every game shares are written once per batch rather
+than once per game. Games finished before the book existed are counted by
+the backfill_position_stats job. Both run on the position-stats queue, one
+task at a time, so the positions are never written concurrently. Looking a
+position up is one get by key."""
+
+import time
+
+import endpoints
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import ai
+import engine
+from models import PositionStats, PositionStatsForm, MoveStatsForm
+
+# Push queue the counting runs on, one task at a time
+QUEUE = 'position-stats'
+# Pull queue of the keys of the finished games still to be counted
+PENDING_QUEUE = 'position-games'
+# Finished games counted per batch
+RECORD_BATCH_SIZE = 100
+# Seconds a record_positions task keeps counting batches before handing
+# over to a new task
+DRAIN_SECONDS = 60
+# Indexes of the outcomes in the PositionStats.replies lists
+WINS, LOSSES, DRAWS = range(3)
+
+
+def is_classic(game):
+    """Returns True for the 3 x 3, three in a row games the book covers"""
+    return game.size == 3 and game.win_length == 3
+
+
+def enqueue_async(game):
+    """Queues a finished game to be counted. Call it in the transaction that
+    ends the game so the game is only queued once it is saved."""
+    task = taskqueue.Task(payload=game.key.urlsafe(), method='PULL')
+    return task.add_async(queue_name=PENDING_QUEUE, transactional=True)
+
+
+def enqueue_drain(name=None):
+    """Enqueues a record_positions task. name keeps a cron job from
+    enqueueing it twice."""
+    try:
+        taskqueue.add(url='/tasks/record_positions', name=name,
+                      queue_name=QUEUE)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def drain():
+    """Counts the queued games in batches until none are left or
+    DRAIN_SECONDS have passed. Returns (games counted, whether games may be
+    left)."""
+    queue = taskqueue.Queue(PENDING_QUEUE)
+    deadline = time.time() + DRAIN_SECONDS
+    counted = 0
+    while time.time() < deadline:
+        tasks = queue.lease_tasks(DRAIN_SECONDS, RECORD_BATCH_SIZE)
+        if not tasks:
+            return counted, False
+        counted += record_games(ndb.get_multi(
+            [ndb.Key(urlsafe=task.payload) for task in tasks]))
+        queue.delete_tasks(tasks)
+    return counted, True
+
+
+def _after(x_mask, o_mask, cell):
+    """Returns the masks after the side to move takes cell"""
+    if bin(x_mask).count('1') == bin(o_mask).count('1'):
+        return engine.place(x_mask, cell), o_mask
+    return x_mask, engine.place(o_mask, cell)
+
+
+def _positions(game):
+    """Yields (position code, reply code, outcome) for each move of a
+    finished game, with the outcome for the side making the move"""
+    history = game.history
+    winning = history[-1]['Player'] if game.winner else None
+    x_mask = o_mask = 0
+    for entry in history:
+        code = ai.canonical(x_mask, o_mask)[0]
+        x_mask, o_mask = _after(x_mask, o_mask, entry['Move'] - 1)
+        if winning is None:
+            outcome = DRAWS
+        else:
+            outcome = WINS if entry['Player'] == winning else LOSSES
+        yield code, ai.canonical(x_mask, o_mask)[0], outcome
+
+
+def record_games(games):
+    """Counts the positions of the finished classic games that are not
+    counted yet, and marks them counted. Returns how many were counted."""
+    games = [game for game in games if game and game.game_over and
+             is_classic(game) and not game.in_position_stats]
+    counts = {}
+    for game in games:
+        for code, reply, outcome in _positions(game):
+            outcomes = counts.setdefault(str(code), {}).setdefault(
+                str(reply), [0, 0, 0])
+            outcomes[outcome] += 1
+    keys = [PositionStats.key_for(code) for code in counts]
+    positions = [position or PositionStats(key=key) for key, position
+                 in zip(keys, ndb.get_multi(keys))]
+    for position in positions:
+        replies = position.replies or {}
+        for reply, outcomes in counts[position.key.id()].items():
+            totals = replies.setdefault(reply, [0, 0, 0])
+            for index, count in enumerate(outcomes):
+                totals[index] += count
+            position.occurrences += sum(outcomes)
+        position.replies = replies
+    for game in games:
+        game.in_position_stats = True
+    ndb.put_multi(positions + games)
+    return len(games)
+
+
+def position_stats(game):
+    """Returns the PositionStatsForm of the game's current position"""
+    if not is_classic(game):
+        raise endpoints.BadRequestException(
+            'Position stats are only kept for 3 x 3 games')
+    if game.game_over:
+        raise endpoints.BadRequestException('Game already over!')
+    x_mask, o_mask = game.mask('X'), game.mask('O')
+    position = PositionStats.key_for(ai.canonical(x_mask, o_mask)[0]).get()
+    replies = position and position.replies or {}
+    moves = []
+    for cell in range(game.cells):
+        if not engine.is_free(x_mask, o_mask, cell):
+            continue
+        reply = ai.canonical(*_after(x_mask, o_mask, cell))[0]
+        outcomes = replies.get(str(reply), [0, 0, 0])
+        moves.append(MoveStatsForm(move=cell + 1, played=sum(outcomes),
+                                   wins=outcomes[WINS],
+                                   losses=outcomes[LOSSES],
+                                   draws=outcomes[DRAWS]))
+    moves.sort(key=lambda move: (-move.played, move.move))
+    return PositionStatsForm(
+        occurrences=position.occurrences if position else 0, moves=moves)
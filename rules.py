@@ -0,0 +1,40 @@
+"""rules.py - The rules of a move, shared by the API and the offline tools.
+Pure functions of the side bitmasks (see engine.py) that never touch the
+datastore, so games can be played and checked without App Engine."""
+
+import engine
+
+
+class IllegalMove(ValueError):
+
+    """A move the rules do not allow. The message is meant for the
+    player."""
+
+
+def check_move(x_mask, o_mask, symbol, to_move, cell, cells=9):
+    """Raises IllegalMove unless symbol ('X', 'O', or None for someone not
+    playing the game) may take cell when it is to_move's turn"""
+    if not 0 <= cell < cells:
+        raise IllegalMove(
+            'Wrong move. Move should be within 1 to {}'.format(cells))
+    if not engine.is_free(x_mask, o_mask, cell):
+        raise IllegalMove('Illegal move. That move has already been made')
+    if symbol not in ('X', 'O'):
+        raise IllegalMove('Your not a valid player for this game')
+    if symbol != to_move:
+        raise IllegalMove('This is not your turn!')
+
+
+def result(mask, cell, number_of_moves, size=3, win_length=3):
+    """Returns engine.WON or engine.TIED if the move just made on cell
+    ended the game, otherwise None. mask is the mover's bitmask including
+    the move and number_of_moves counts it."""
+    # It takes minimum 2 * win_length - 1 moves for a person to win.
+    # Only the lines through the new move can have been completed
+    if number_of_moves >= 2 * win_length - 1 and \
+            engine.is_winning_move(mask, cell, size, win_length):
+        return engine.WON
+    # A full board without a winning line is a tie
+    if number_of_moves == size * size:
+        return engine.TIED
+    return None
@@ -1,9 +1,96 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import threading
+import time
+from collections import OrderedDict
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 import endpoints
 
+import instrumentation
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Entries held by the in-process cache of each instance
+LOCAL_CACHE_SIZE = 2000
+# Seconds an entity stays in the in-process cache. Puts on this instance
+# invalidate it at once; this bounds how stale other instances can be.
+LOCAL_ENTITY_TTL = 5
+
+
+class LRUCache(object):
+
+    """Bounded, thread safe least recently used cache with optional
+    per-entry expiry"""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Caches value, evicting the least recently used entry if full"""
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drops key from the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+local_cache = LRUCache(LOCAL_CACHE_SIZE)
+
+
+def _key_from_urlsafe(urlsafe):
+    """Returns the ndb.Key a urlsafe key string encodes. Raises
+    BadRequestException if the string is malformed"""
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key a urlsafe key string encodes, without reading the
+        entity. Checks that the key is of the expected kind.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The Key the urlsafe Key string encodes
+    Raises:
+        BadRequestException: If the key String is malformed or of the
+        incorrect kind"""
+    key = _key_from_urlsafe(urlsafe)
+    if key.kind() != model._get_kind():
+        raise endpoints.BadRequestException('Invalid Key')
+    return key
+
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -18,19 +105,94 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception, e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
-
-    entity = key.get()
+    entity = _key_from_urlsafe(urlsafe).get()
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+def fetch_page(query, page_size=None, cursor=None, **options):
+    """Fetches one page of query results starting at a urlsafe cursor.
+    Args:
+        query: The ndb.Query to run
+        page_size: Requested number of results, capped at MAX_PAGE_SIZE
+        cursor: A urlsafe cursor string from a previous page, or None
+        options: Extra query options such as projection or keys_only
+    Returns:
+        A (results, next_cursor) tuple, where next_cursor is the urlsafe
+        cursor of the next page or None if this is the last page.
+    Raises:
+        BadRequestException: If the cursor is malformed"""
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    if page_size < 1:
+        raise endpoints.BadRequestException('page_size must be positive')
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+    results, next_cursor, more = query.fetch_page(
+        page_size, start_cursor=start_cursor, **options)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+def _name_cache_key(model, name):
+    return 'name:{}:{}'.format(model._get_kind(), name.encode('utf-8'))
+
+
+def get_key_by_name(model, name):
+    """Returns the key of the model entity with the given unique name, or
+    None if there is none. Names never change once taken, so the mapping is
+    cached in-process and in memcache without expiry; misses are not
+    cached."""
+    if not name:
+        return None
+    cache_key = _name_cache_key(model, name)
+    key = local_cache.get(cache_key)
+    if key is not None:
+        instrumentation.count_cache(hit=True)
+        return key
+    urlsafe = memcache.get(cache_key)
+    instrumentation.count_cache(hit=bool(urlsafe))
+    if urlsafe:
+        key = ndb.Key(urlsafe=urlsafe)
+    else:
+        key = model.query(model.name == name).get(keys_only=True)
+        if key is None:
+            return None
+        memcache.set(cache_key, key.urlsafe())
+    local_cache.set(cache_key, key)
+    return key
+
+
+def get_entities(keys):
+    """Returns the entities for keys, in order, with None for missing ones.
+    Entities are served from the in-process cache when possible; the rest
+    are read with one ndb.get_multi, which is backed by ndb's memcache
+    tier. Do not use for entities about to be modified - read those
+    straight from the datastore."""
+    entities = [local_cache.get(key) for key in keys]
+    missing = [key for key, entity in zip(keys, entities) if entity is None]
+    for entity in entities:
+        instrumentation.count_cache(hit=entity is not None)
+    if missing:
+        fetched = dict(zip(missing, ndb.get_multi(missing)))
+        for index, key in enumerate(keys):
+            if entities[index] is None:
+                entities[index] = fetched[key]
+                if entities[index] is not None:
+                    local_cache.set(key, entities[index], LOCAL_ENTITY_TTL)
+    return entities
+
+
+def get_entity(key):
+    """Returns the entity for key through the cache, or None"""
+    return get_entities([key])[0]
+
+
+def invalidate(key):
+    """Drops the cached copy of the entity with the given key. Inside a
+    transaction this happens once the transaction commits."""
+    ndb.get_context().call_on_commit(lambda: local_cache.delete(key))